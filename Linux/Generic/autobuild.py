@@ -12,16 +12,30 @@
 #   pip install inotify
 
 import argparse
+import configparser
+import hashlib
+import inspect
+import json
+import math
 import os
 import re
+import select
+import shlex
+import shutil
+import signal
+import socket
 import subprocess
 import sys
-from fnmatch import fnmatch
+import tempfile
+import time
+from collections import deque, namedtuple
+from types import SimpleNamespace
 
 import inotify.adapters
+import inotify.calls
 from inotify.constants import (
-    IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_MODIFY, IN_MOVE, IN_MOVE_SELF,
-    IN_MOVED_FROM, IN_MOVED_TO)
+    IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_ISDIR, IN_MODIFY, IN_MOVE,
+    IN_MOVE_SELF, IN_MOVED_FROM, IN_MOVED_TO)
 
 enable_notifications = False
 # default_mask = (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MODIFY |
@@ -29,7 +43,8 @@ enable_notifications = False
 default_mask = (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE |
                 IN_MOVE | IN_MOVED_FROM | IN_MOVED_TO | IN_MOVE_SELF)
 
-default_exclude_re = re.compile(rb'^(.*~|\.#.*|#.*#)$')
+# Editor backups and lock files
+default_excludes = ['*~', '.#*', '#*#']
 
 
 def quote_command(command):
@@ -68,65 +83,546 @@ def parse_args():
         help='Add a directory to the watch list')
     parser.add_argument(
         '-e', '--exclude', action='append', dest='exclude_paths', default=[],
-        help='Exclude files matching this (glob) pattern')
+        help='Exclude files matching this (glob) pattern, with .gitignore '
+        'semantics: an excluded directory is not watched at all')
+    parser.add_argument(
+        '-g', '--gitignore', action='store_true', default=False,
+        help='Also exclude what .gitignore (and .git/info/exclude) in the '
+        'listen paths ignore')
+    parser.add_argument(
+        '-d', '--debounce', type=float, default=0.3, metavar='SECONDS',
+        help='Wait for this long without changes before building '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '-c', '--cancel-stale', action='store_true', default=False,
+        help='Stop the running command when more changes come in, '
+        'instead of waiting for it before building again')
+    parser.add_argument(
+        '-H', '--content-hash', action='store_true', default=False,
+        help='Only build when the content of a file actually changed, '
+        'ignoring files rewritten with the same bytes or just touched')
+    parser.add_argument(
+        '--hash-cache', metavar='FILE',
+        help='Where to keep file hashes between runs (default: a file '
+        'in ~/.cache/autobuild named after the listen paths)')
+    parser.add_argument(
+        '-C', '--config', metavar='FILE',
+        help='Read build targets from this file: one [section] per '
+        'target, with "patterns" (globs, ** for any directories) and '
+        '"command", and optionally "workdir". Only the targets matching '
+        'the changed files get built')
+    parser.add_argument(
+        '-j', '--jobs', type=int, metavar='N',
+        help='Run up to N targets at the same time '
+        '(default: all of them)')
+    parser.add_argument(
+        '--history', metavar='FILE', default=default_history(),
+        help='Append the timings of every build to this file '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--stats', action='store_true', default=False,
+        help='Print build time percentiles and the slowest triggering '
+        'paths from the history, then exit')
+    parser.add_argument(
+        '-W', '--warm', action='store_true', default=False,
+        help='Run "python -m MODULE ..." and "python SCRIPT ..." commands '
+        'in a child forked from a long-lived worker, where MODULE and '
+        '--preload modules are already imported; other commands are '
+        'started normally')
+    parser.add_argument(
+        '--preload', action='append', default=[], metavar='MODULE[,...]',
+        help='Modules for the warm worker to import beforehand')
     parser.add_argument(
         '-n', '--notify', action='store_true', dest='notify', default=False,
         help='Send notifications about the command exit status')
     parser.add_argument(
         'command', nargs=argparse.REMAINDER,
-        help='Command to be executed upon events')
+        help='Command to be executed upon events. An argument that is '
+        'just {} is replaced by the changed files, which are also listed '
+        'in $AUTOBUILD_CHANGED and in the file named by '
+        '$AUTOBUILD_CHANGED_FILE')
 
     return parser.parse_args()
 
 
-def name_match(name, exclude_paths):
-    if default_exclude_re.match(name):
-        return False
+class ExcludeMatcher:
+    """Exclude patterns, compiled once into a regex for files and one
+    for directories, matched against paths relative to the listen path.
 
-    exclude_patterns = (x.encode() for x in exclude_paths)
-    for pattern in exclude_patterns:
-        if fnmatch(name, pattern):
-            return False
-    return True
+    Patterns follow .gitignore rules: a pattern without a slash matches
+    at any depth, one with a slash is anchored, a trailing slash only
+    matches directories, and anything under an excluded directory is
+    excluded too. ``!pattern`` re-includes what matches it, whatever
+    the order of the patterns.
+    """
+
+    def __init__(self, patterns, roots):
+        self.roots = roots
+        exclude, exclude_files, keep, keep_files = [], [], [], []
+        for pattern in patterns:
+            negate = pattern.startswith('!')
+            pattern = pattern[1:] if negate else pattern
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            regex = glob_to_regex(pattern.lstrip('/'))
+            if '/' not in pattern:
+                regex = '(?:.*/)?' + regex
+            (keep if negate else exclude).append(regex)
+            if not dir_only:
+                (keep_files if negate else exclude_files).append(regex)
+
+        self._dir_re = self._compile(exclude, exclude)
+        self._file_re = self._compile(exclude, exclude_files)
+        self._keep_dir_re = self._compile(keep, keep)
+        self._keep_file_re = self._compile(keep, keep_files)
+
+    @staticmethod
+    def _compile(dirs, names):
+        """Paths under one of ``dirs``, or matching one of ``names``"""
+        if not dirs:
+            return None
+        regex = '(?:{})/.*'.format('|'.join(dirs))
+        if names:
+            regex += '|(?:{})'.format('|'.join(names))
+        return re.compile('(?:{})$'.format(regex), re.S)
+
+    def excluded(self, path, is_dir=False):
+        rel = relative_path(path, self.roots)
+        if is_dir:
+            match, keep = self._dir_re, self._keep_dir_re
+        else:
+            match, keep = self._file_re, self._keep_file_re
+        return (match is not None and match.match(rel) is not None and
+                (keep is None or keep.match(rel) is None))
+
+
+def read_gitignore(root):
+    patterns = ['.git/']
+    for name in ('.gitignore', os.path.join('.git', 'info', 'exclude')):
+        try:
+            with open(os.path.join(root, name)) as fp:
+                lines = fp.read().splitlines()
+        except OSError:
+            continue
+        patterns.extend(line.rstrip() for line in lines
+                        if line.strip() and not line.startswith('#'))
+    return patterns
 
 
 class InotifyTrees(inotify.adapters.BaseTree):
+    """Recursive watcher over a set of trees, meant to live for the
+    whole session: watches follow directories as they are created,
+    moved or removed, instead of walking everything again.
+    """
 
     # FORKED TO FIX UNICODE BUG IN __load_trees()
 
     def __init__(self, paths, mask=inotify.constants.IN_ALL_EVENTS,
-                 block_duration_s=inotify.adapters._DEFAULT_EPOLL_BLOCK_DURATION_S):  # noqa
+                 block_duration_s=inotify.adapters._DEFAULT_EPOLL_BLOCK_DURATION_S,  # noqa
+                 exclude=None):
         super().__init__(mask=mask, block_duration_s=block_duration_s)
+        self._mask |= IN_MOVED_FROM | IN_MOVED_TO
+        # Directories for which exclude(path) is true are not watched
+        self.exclude = exclude or (lambda path: False)
+        # Watched directory -> its watched subdirectories
+        self.watched = {}
         self.__load_trees(paths)
 
     def __load_trees(self, paths):
-        q = paths
+        q = deque(paths)
         while q:
-            current_path = q[0]
-            del q[0]
+            current_path = q.popleft()
+            try:
+                self._i.add_watch(current_path, self._mask)
+                entries = list(os.scandir(current_path))
+            except (inotify.calls.InotifyError, OSError):
+                continue  # Removed (or unreadable) in the meantime
+            self.watched.setdefault(current_path, set())
+            parent = self.watched.get(os.path.dirname(current_path))
+            if parent is not None:
+                parent.add(current_path)
+
+            for entry in entries:
+                if (entry.is_dir(follow_symlinks=False) and
+                        not self.exclude(entry.path)):
+                    q.append(entry.path)
+
+    def __unload_tree(self, path, superficial):
+        self.watched.get(os.path.dirname(path), set()).discard(path)
+        q = deque([path])
+        while q:
+            current_path = q.popleft()
+            children = self.watched.pop(current_path, None)
+            if children is None:
+                continue
+            q.extend(children)
+            try:
+                self._i.remove_watch(current_path, superficial=superficial)
+            except inotify.calls.InotifyError:
+                pass
+
+    def event_gen(self):
+        for event in self._i.event_gen():
+            if event is not None:
+                header, _, path, filename = event
+                if header.mask & IN_ISDIR:
+                    full_path = os.path.join(path, filename)
+                    if header.mask & (IN_CREATE | IN_MOVED_TO):
+                        # Whole trees can show up at once (mv, mkdir -p)
+                        if not self.exclude(full_path):
+                            self.__load_trees([full_path])
+                    elif header.mask & IN_DELETE:
+                        # The kernel already dropped these watches
+                        self.__unload_tree(full_path, superficial=True)
+                    elif header.mask & IN_MOVED_FROM:
+                        self.__unload_tree(full_path, superficial=False)
+            yield event
+
+
+def glob_to_regex(pattern):
+    """Translate a glob where ``**`` spans directories into a regex"""
+    parts = []
+    for token in re.split(r'(\*\*/|\*\*|\*|\?|\[[^]]+\])', pattern):
+        if token == '**/':
+            parts.append('(?:.*/)?')
+        elif token == '**':
+            parts.append('.*')
+        elif token == '*':
+            parts.append('[^/]*')
+        elif token == '?':
+            parts.append('[^/]')
+        elif token.startswith('[') and token.endswith(']') and len(token) > 2:
+            parts.append('[' + re.sub(r'^!', '^', token[1:-1])
+                         .replace('\\', '\\\\') + ']')
+        else:
+            parts.append(re.escape(token))
+    return ''.join(parts)
+
+
+Target = namedtuple('Target', 'name, command, workdir, matcher')
+
+
+def compile_patterns(patterns):
+    """A single regex matching paths relative to a listen path.
+
+    Patterns without a slash apply to the file name in any directory.
+    """
+    regexes = []
+    for pattern in patterns:
+        regex = glob_to_regex(pattern.strip('/'))
+        if '/' not in pattern:
+            regex = '(?:.*/)?' + regex
+        regexes.append(regex)
+    return re.compile('(?:{})$'.format('|'.join(regexes)))
+
+
+def load_config(filename, workdir):
+    config = configparser.ConfigParser(interpolation=None)
+    with open(filename) as fp:
+        config.read_file(fp)
+    targets = []
+    for name in config.sections():
+        section = config[name]
+        targets.append(Target(
+            name, shlex.split(section['command']),
+            section.get('workdir', workdir),
+            compile_patterns(section.get('patterns', '**').split())))
+    return targets
+
 
-            self._i.add_watch(current_path, self._mask)
+def relative_path(path, roots):
+    """``path`` relative to the (normalized) listen path containing it"""
+    for root in roots:
+        if path.startswith(root) and path[len(root):len(root) + 1] == '/':
+            return path[len(root) + 1:]
+    return path
 
-            for filename in os.listdir(current_path):
-                entry_filepath = os.path.join(current_path, filename)
-                if os.path.isdir(entry_filepath) is False:
+
+class WorkerSlots:
+    """Bound the number of commands running at the same time"""
+
+    def __init__(self, size):
+        self.free = size
+
+    def acquire(self):
+        if self.free <= 0:
+            return False
+        self.free -= 1
+        return True
+
+    def release(self):
+        self.free += 1
+
+
+def event_matches(event, excludes):
+    header, _, path, filename = event
+    if not header.mask & default_mask:
+        return False
+    return not excludes.excluded(os.path.join(path, filename).decode(),
+                                 bool(header.mask & IN_ISDIR))
+
+
+class ContentCache:
+    """Tell actual content changes apart from no-op writes and touches.
+
+    Keeps ``path -> [size, mtime_ns, hash]``. A different size is a
+    change; a file is only hashed when its size is the same but its
+    mtime is not, or when saving (before each build) if the hash is
+    still missing, rather than on each event of a storm. The cache is
+    saved to ``filename`` so that files keep their state across
+    restarts.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as fp:
+                self.entries = json.load(fp)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def changed(self, path):
+        path = os.path.abspath(os.fsdecode(path))
+        old = self.entries.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:  # Removed
+            self.entries.pop(path, None)
+            return True
+        if not os.path.isfile(path):
+            return True
+
+        size, mtime = st.st_size, st.st_mtime_ns
+        if old is None or old[0] != size:
+            self.entries[path] = [size, mtime, None]
+            return True
+        if old[1] == mtime:
+            return False
+
+        digest = _file_hash(path)
+        self.entries[path] = [size, mtime, digest]
+        return digest is None or digest != old[2]
+
+    def save(self):
+        for path, entry in self.entries.items():
+            if entry[2] is None:
+                try:
+                    st = os.stat(path)
+                except OSError:
                     continue
+                if [st.st_size, st.st_mtime_ns] == entry[:2]:
+                    entry[2] = _file_hash(path)
 
-                q.append(entry_filepath)
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(self.entries, fp, separators=(',', ':'))
+        os.replace(tmp, self.filename)
 
 
-def block_until_next_event(listen_paths, exclude_paths):
-    listen_paths = [x.encode() for x in listen_paths]
-    watcher = InotifyTrees(listen_paths)
-    for event in watcher.event_gen():
-        if event is None:
-            continue  # hmm...
-        # msg(event, color='2')
-        header, _, _, filename = event
-        if not header.mask & default_mask:
-            continue
-        if name_match(filename, exclude_paths):
-            return event
+def _file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 16), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def default_hash_cache(listen_paths):
+    key = '\0'.join(sorted(os.path.abspath(x) for x in listen_paths))
+    return os.path.join(
+        os.path.expanduser('~/.cache/autobuild'),
+        hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+# Measured for each build, in seconds (maxrss: peak RSS in KiB)
+BUILD_TIMINGS = ('latency', 'debounce', 'wall', 'cpu', 'maxrss')
+
+# Changed paths kept in the history for each build
+HISTORY_PATHS = 10
+
+
+def default_history():
+    return os.path.expanduser('~/.cache/autobuild/history.jsonl')
+
+
+def append_history(filename, record):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'a') as fp:
+        fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted ``values``"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def print_stats(filename, top=10):
+    records = []
+    try:
+        with open(filename) as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass  # Cut short by a crash
+    except OSError as e:
+        msg('Cannot read {}: {}'.format(filename, e), color='31')
+        sys.exit(1)
+
+    finished = [x for x in records if not x.get('cancelled')]
+    print('{} builds ({} stopped) in {}'.format(
+        len(records), len(records) - len(finished), filename))
+    if not finished:
+        return
+
+    print('{:<10} {:>10} {:>10}'.format('', 'p50', 'p95'))
+    for key in BUILD_TIMINGS:
+        values = sorted(x[key] for x in finished)
+        if key == 'maxrss':
+            row = ['{:.1f}M'.format(percentile(values, f) / 1024)
+                   for f in (.5, .95)]
+        else:
+            row = ['{:.3f}s'.format(percentile(values, f))
+                   for f in (.5, .95)]
+        print('{:<10} {:>10} {:>10}'.format(key, *row))
+
+    targets = sorted(set(x.get('target') or '' for x in finished))
+    if len(targets) > 1:
+        print()
+        print('{:<20} {:>6} {:>10} {:>10}'.format(
+            'target (wall)', 'builds', 'p50', 'p95'))
+        for target in targets:
+            values = sorted(x['wall'] for x in finished
+                            if (x.get('target') or '') == target)
+            print('{:<20} {:>6} {:>9.3f}s {:>9.3f}s'.format(
+                target, len(values), percentile(values, .5),
+                percentile(values, .95)))
+
+    by_path = {}
+    for record in finished:
+        for path in record.get('paths', ()):
+            by_path.setdefault(path, []).append(record['wall'])
+    print()
+    print('Slowest triggering paths (mean wall time):')
+    slowest = sorted(by_path.items(),
+                     key=lambda kv: -sum(kv[1]) / len(kv[1]))[:top]
+    for path, walls in slowest:
+        print('{:>9.3f}s {:>5}x  {}'.format(
+            sum(walls) / len(walls), len(walls), path))
+
+
+class BuildScheduler:
+    """Coalesce change events into as few builds as possible.
+
+    A build starts once no event came in for ``debounce`` seconds.
+    Events arriving while a build runs queue (at most) one follow-up
+    build, or, with ``cancel_stale``, stop the running build, which is
+    now out of date.
+
+    ``start_build(events)`` must return a ``subprocess.Popen``;
+    ``finish_build(retval, cancelled, timing)`` is called once it exits,
+    with a dict of ``BUILD_TIMINGS``. Builds wait for one of the
+    (shared) ``WorkerSlots`` to be free, if given.
+    """
+
+    # How often to check whether the running build has finished
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, start_build, finish_build, debounce=0.3,
+                 cancel_stale=False, slots=None, clock=time.monotonic):
+        self.start_build = start_build
+        self.finish_build = finish_build
+        self.slots = slots
+        self.debounce = debounce
+        self.cancel_stale = cancel_stale
+        self.clock = clock
+        self.pending = []
+        self.first_event = self.last_event = None
+        self.process = None
+        self.cancelled = False
+        self.timing = None
+
+    def notify(self, event):
+        if not self.pending:
+            self.first_event = self.clock()
+        self.pending.append(event)
+        self.last_event = self.clock()
+        if (self.cancel_stale and self.process is not None and
+                not self.cancelled):
+            self.cancelled = True
+            _kill_group(self.process, signal.SIGTERM)
+
+    def poll(self):
+        """Reap the finished build and start the next one, when due"""
+        if self.process is not None:
+            if not self._reap(os.WNOHANG):
+                return
+            if self.slots is not None:
+                self.slots.release()
+
+        if (self.pending and
+                self.clock() - self.last_event >= self.debounce and
+                (self.slots is None or self.slots.acquire())):
+            events, self.pending = self.pending, []
+            now = self.clock()
+            self.timing = {
+                'latency': now - self.first_event,
+                'debounce': now - self.last_event,
+                'started': now,
+            }
+            self.process = self.start_build(events)
+
+    def _reap(self, options):
+        """Collect the exit status and resource usage of the build"""
+        pid, status, usage = _wait4(self.process, options)
+        if not pid:
+            return False
+        # Tell Popen, so that it doesn't try to reap the process again
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        timing = self.timing
+        timing['wall'] = self.clock() - timing.pop('started')
+        timing['cpu'] = usage.ru_utime + usage.ru_stime
+        timing['maxrss'] = usage.ru_maxrss
+        retval, cancelled = self.process.returncode, self.cancelled
+        self.process, self.cancelled, self.timing = None, False, None
+        self.finish_build(retval, cancelled, timing)
+        return True
+
+    def timeout(self):
+        """How long to wait for events before calling ``poll()`` again"""
+        if self.process is not None:
+            return self.POLL_INTERVAL
+        if self.pending:
+            remaining = self.last_event + self.debounce - self.clock()
+            # Past the quiet window, we are waiting for a worker slot
+            return remaining if remaining > 0 else self.POLL_INTERVAL
+        return 1
+
+    def stop(self):
+        if self.process is not None:
+            _kill_group(self.process, signal.SIGTERM)
+            self.cancelled = True
+            self._reap(0)
+
+
+def _wait4(process, options):
+    wait4 = getattr(process, 'wait4', None)  # A WarmProcess
+    if wait4 is not None:
+        return wait4(options)
+    return os.wait4(process.pid, options)
+
+
+def _kill_group(process, sig):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
 
 
 def check_notify_send():
@@ -142,15 +638,281 @@ def send_notification(title, description, icon, urgency='normal',
         '--expire-time', str(timeout)])
 
 
-def run_command(command, **kwargs):
+# Above this, $AUTOBUILD_CHANGED is left unset (see $AUTOBUILD_CHANGED_FILE)
+MAX_CHANGED_ENV = 64 * 1024
+
+
+def changed_paths(events, workdir):
+    """The paths still existing after ``events``, without duplicates,
+    relative to ``workdir`` when they are inside it.
+    """
+    paths = {}
+    for _, _, path, filename in events:
+        full_path = os.path.join(path, filename).decode()
+        if not os.path.exists(full_path):
+            continue
+        rel = os.path.relpath(full_path, workdir)
+        if rel == '..' or rel.startswith('..' + os.sep):
+            rel = os.path.abspath(full_path)
+        paths[rel] = None
+    return list(paths)
+
+
+def warm_worker(fd, preload, main_module=None):
+    """Main loop of the warm worker, run from its source code by the
+    interpreter of the build command (so it can't use anything else
+    from this file): import ``preload``, then for each build request on
+    the ``fd`` socket, fork a child running it and report its exit.
+
+    The packages of ``main_module`` get imported too, but not the
+    module itself unless it is a package, since importing a script-like
+    module would run it.
+    """
+    import importlib
+    import importlib.util
+    import json
+    import os
+    import runpy
+    import signal
+    import socket
+    import sys
+    import traceback
+
+    # Ctrl-C is for autobuild, which stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sock = socket.socket(fileno=fd)
+    reader = sock.makefile('rb')
+
+    def send(**message):
+        sock.sendall(json.dumps(message).encode() + b'\n')
+
+    try:
+        for name in preload:
+            importlib.import_module(name)
+        if main_module:
+            name = main_module
+            spec = importlib.util.find_spec(name)  # Imports the parents
+            if spec is not None and spec.submodule_search_locations:
+                importlib.import_module(name)
+    except BaseException as e:
+        send(error='cannot import {}: {!r}'.format(name, e))
+        return
+    send(files=sorted(set(
+        os.path.realpath(module.__file__)
+        for module in list(sys.modules.values())
+        if getattr(module, '__file__', None))))
+
+    for line in reader:
+        request = json.loads(line.decode())
+        pid = os.fork()
+        if not pid:
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 1
+            try:
+                sock.close()
+                os.chdir(request['cwd'])
+                os.environ.clear()
+                os.environ.update(request['env'])
+                sys.argv = request['argv']
+                if request['module']:
+                    sys.path[0] = os.getcwd()
+                    runpy.run_module(request['module'], run_name='__main__',
+                                     alter_sys=True)
+                else:
+                    sys.path[0] = os.path.dirname(
+                        os.path.abspath(sys.argv[0]))
+                    runpy.run_path(sys.argv[0], run_name='__main__')
+                code = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    code = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(code)
+
+        try:
+            os.setpgid(pid, pid)  # Before we tell its pid to be killed
+        except OSError:
+            pass
+        send(pid=pid)
+        _, status, usage = os.wait4(pid, 0)
+        send(status=status, utime=usage.ru_utime, stime=usage.ru_stime,
+             maxrss=usage.ru_maxrss)
+
+
+def python_entry(command):
+    """``(module, argv)`` for ``python -m module ...`` commands, and
+    ``(None, argv)`` for ``python script ...``; otherwise None.
+    """
+    if (len(command) < 2 or
+            not os.path.basename(command[0]).startswith('python')):
+        return None
+    if command[1] == '-m' and len(command) > 2:
+        return command[2], command[2:]
+    if command[1].startswith('-'):
+        return None
+    return None, command[1:]
+
+
+class WarmServer:
+    """A long-lived ``warm_worker`` for a Python build command.
+
+    Builds are forked from it with their modules already imported,
+    instead of paying for the interpreter startup and imports each time.
+    When one of the files it imported changes, it gets restarted.
+    """
+
+    def __init__(self, command, preload, cwd):
+        self.interpreter = shutil.which(command[0]) or command[0]
+        self.preload = list(preload)
+        self.main_module = python_entry(command)[0]
+        self.cwd = cwd
+        self.process = None
+        self.files = set()
+
+    def start(self):
+        """Start the worker and wait until it is ready"""
+        self.stop()
+        ours, theirs = socket.socketpair()
+        source = '{}\nwarm_worker({}, {!r}, {!r})\n'.format(
+            inspect.getsource(warm_worker), theirs.fileno(), self.preload,
+            self.main_module)
+        try:
+            self.process = subprocess.Popen(
+                [self.interpreter, '-c', source], pass_fds=[theirs.fileno()],
+                stdin=subprocess.DEVNULL, cwd=self.cwd)
+        except OSError as e:
+            msg('Cannot start the warm worker: {}'.format(e), '33')
+            return False
+        finally:
+            theirs.close()
+        # Unbuffered, so that select() in wait4() sees every reply that
+        # hasn't been read yet
+        self.sock, self.reader = ours, ours.makefile('rb', buffering=0)
+        reply = self._receive()
+        if 'files' not in reply:
+            msg('Warm worker failed: {}'.format(
+                reply.get('error', 'exited')), '33')
+            self.stop()
+            return False
+        self.files = set(reply['files'])
+        return True
+
+    def stop(self):
+        if self.process is not None:
+            self.sock.close()
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def stale(self, paths):
+        return any(os.path.realpath(x) in self.files for x in paths)
+
+    def spawn(self, command, cwd, env):
+        """Run ``command`` in a fork of the worker, as a ``WarmProcess``;
+        None when the worker can't be (re)started.
+        """
+        module, argv = python_entry(command)
+        for attempt in range(2):
+            if self.process is None and not self.start():
+                return None
+            try:
+                self.sock.sendall(json.dumps({
+                    'module': module, 'argv': argv, 'cwd': cwd,
+                    'env': env}).encode() + b'\n')
+                reply = self._receive()
+            except OSError:
+                reply = {}
+            if 'pid' in reply:
+                return WarmProcess(self, reply['pid'])
+            self.stop()  # Died, try again with a new one
+        return None
+
+    def wait4(self, pid, options):
+        if (options & os.WNOHANG and
+                not select.select([self.sock], [], [], 0)[0]):
+            return 0, 0, None
+        reply = self._receive()
+        if 'status' not in reply:  # The worker died, and the build with it
+            self.stop()
+            return pid, 1 << 8, SimpleNamespace(
+                ru_utime=0, ru_stime=0, ru_maxrss=0)
+        return pid, reply['status'], SimpleNamespace(
+            ru_utime=reply['utime'], ru_stime=reply['stime'],
+            ru_maxrss=reply['maxrss'])
+
+    def _receive(self):
+        line = self.reader.readline()
+        return json.loads(line.decode()) if line else {}
+
+
+class WarmProcess:
+    """The part of ``Popen`` the scheduler uses, for warm builds"""
+
+    def __init__(self, server, pid):
+        self.server = server
+        self.pid = pid
+        self.returncode = None
+
+    def wait4(self, options):
+        return self.server.wait4(self.pid, options)
+
+
+def start_command(command, name=None, changed=None, warm=None, **kwargs):
+    """Start ``command``, telling it about the ``changed`` paths.
+
+    An argument that is exactly ``{}`` gets replaced by the paths; the
+    command also finds them in the file named by $AUTOBUILD_CHANGED_FILE
+    and, if not too long, in $AUTOBUILD_CHANGED (one per line).
+    With a ``WarmServer``, the command is forked from it when possible.
+    Returns the process and the name of the file, to be removed.
+    """
+    changed = changed or []
+    command = [y for x in command for y in (changed if x == '{}' else [x])]
+    msg('{}Running command: {}'.format(
+        '[{}] '.format(name) if name else '', quote_command(command)), '34')
+
+    fd, changed_file = tempfile.mkstemp(prefix='autobuild-', suffix='.txt')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(''.join(x + '\n' for x in changed))
+    env = dict(kwargs.pop('env', None) or os.environ)
+    env['AUTOBUILD_CHANGED_FILE'] = changed_file
+    env.pop('AUTOBUILD_CHANGED', None)
+    if sum(len(x) + 1 for x in changed) <= MAX_CHANGED_ENV:
+        env['AUTOBUILD_CHANGED'] = '\n'.join(changed)
+
+    if warm is not None:
+        process = warm.spawn(command, kwargs.get('cwd') or os.getcwd(), env)
+        if process is not None:
+            return process, changed_file
+        msg('Warm worker unavailable, starting the command normally', '33')
+
+    # In its own process group, so that the whole build can be stopped
+    process = subprocess.Popen(command, start_new_session=True, env=env,
+                               **kwargs)
+    return process, changed_file
+
+
+def report_command(command, retval, cancelled=False, name=None, **kwargs):
     cmd_repr = quote_command(command)
-    msg('Running command: {}'.format(cmd_repr), '34')
-    retval = subprocess.call(command, **kwargs)
+    prefix = '[{}] '.format(name) if name else ''
+    if cancelled:
+        msg(prefix + 'Command stopped', '33')
+        return
 
     if not retval:
-        msg('Command execution successful', '32')
+        msg(prefix + 'Command execution successful', '32')
     else:
-        msg('Command execution failed with code {}'.format(retval), '31')
+        msg(prefix + 'Command execution failed with code {}'.format(retval),
+            '31')
 
     if enable_notifications:
         if retval == 0:  # success
@@ -179,29 +941,132 @@ def main():
     global enable_notifications
 
     args = parse_args()
-    workdir = args.workdir or os.getcwd()
+    if args.stats:
+        print_stats(args.history)
+        return
+
+    workdir = os.path.abspath(args.workdir or os.getcwd())
     if not len(args.listen_paths):
         msg('At least one listen path is required', color='31')
         sys.exit(1)
+    args.listen_paths = [os.path.normpath(x) for x in args.listen_paths]
+
+    exclude_patterns = default_excludes + args.exclude_paths
+    if args.gitignore:
+        for path in args.listen_paths:
+            exclude_patterns.extend(read_gitignore(path))
+    excludes = ExcludeMatcher(exclude_patterns, args.listen_paths)
 
     enable_notifications = args.notify
     if enable_notifications and (not check_notify_send()):
         msg('Program notify-send not found. Disabling notifications.', '33')
         enable_notifications = False
 
+    if args.config:
+        try:
+            targets = load_config(args.config, workdir)
+        except (OSError, configparser.Error, KeyError) as e:
+            msg('Cannot read {}: {}'.format(args.config, e), color='31')
+            sys.exit(1)
+    elif args.command:
+        targets = [Target(None, args.command, workdir, None)]
+    else:
+        msg('A command or a config file is required', color='31')
+        sys.exit(1)
+
     for path in args.listen_paths:
         print('Listening on: {}'.format(path))
-    print('Will run: {}'.format(quote_command(args.command)))
+    for target in targets:
+        print('Will run: {}{}'.format(
+            '[{}] '.format(target.name) if target.name else '',
+            quote_command(target.command)))
     print('-' * 60)
 
-    while True:
-        event = block_until_next_event(args.listen_paths, args.exclude_paths)
-        hdr, names, path, filename = event
-        msg('{} {}'
-            .format(', '.join(names),
-                    os.path.join(path, filename).decode()),
-            color='2')
-        run_command(args.command, cwd=workdir)
+    contents = None
+    if args.content_hash:
+        contents = ContentCache(
+            args.hash_cache or default_hash_cache(args.listen_paths))
+
+    slots = WorkerSlots(args.jobs or len(targets))
+    preload = [x for arg in args.preload for x in arg.split(',') if x]
+    warm_servers = []
+
+    def make_scheduler(target):
+        build = {}
+        warm = None
+        entry = python_entry(target.command) if args.warm else None
+        if entry is not None:
+            warm = WarmServer(target.command, preload, target.workdir)
+            warm_servers.append(warm)
+            warm.start()
+
+        def start_build(events):
+            if contents is not None:
+                contents.save()
+            build['paths'] = changed_paths(events, target.workdir)
+            if warm is not None and warm.stale(
+                    os.path.join(target.workdir, x) for x in build['paths']):
+                msg('Imported files changed, restarting the warm worker',
+                    '33')
+                warm.start()
+            process, build['changed_file'] = start_command(
+                target.command, target.name, build['paths'], warm=warm,
+                cwd=target.workdir)
+            return process
+
+        def finish_build(retval, cancelled, timing):
+            os.unlink(build['changed_file'])
+            report_command(target.command, retval, cancelled, target.name,
+                           cwd=target.workdir)
+            record = {'time': round(time.time(), 3), 'target': target.name,
+                      'retval': retval, 'cancelled': cancelled,
+                      'paths': build['paths'][:HISTORY_PATHS]}
+            record.update((key, round(value, 3))
+                          for key, value in timing.items())
+            try:
+                append_history(args.history, record)
+            except OSError as e:
+                msg('Cannot write {}: {}'.format(args.history, e), '33')
+
+        return BuildScheduler(
+            start_build, finish_build, debounce=args.debounce,
+            cancel_stale=args.cancel_stale, slots=slots)
+
+    schedulers = [(target, make_scheduler(target)) for target in targets]
+
+    def is_change(event):
+        if event is None or not event_matches(event, excludes):
+            return False
+        hdr, _, path, filename = event
+        return (contents is None or hdr.mask & IN_ISDIR or
+                contents.changed(os.path.join(path, filename)))
+
+    # Events coming in during builds are kept by the schedulers
+    watcher = InotifyTrees(
+        [x.encode() for x in args.listen_paths], mask=default_mask,
+        block_duration_s=lambda: min(s.timeout() for _, s in schedulers),
+        exclude=lambda path: excludes.excluded(path.decode(), True))
+    try:
+        for event in watcher.event_gen():
+            if is_change(event):
+                hdr, names, path, filename = event
+                full_path = os.path.join(path, filename).decode()
+                msg('{} {}'.format(', '.join(names), full_path), color='2')
+                rel_path = relative_path(full_path, args.listen_paths)
+                for target, scheduler in schedulers:
+                    if (target.matcher is None or
+                            target.matcher.match(rel_path)):
+                        scheduler.notify(event)
+            for _, scheduler in schedulers:
+                scheduler.poll()
+    except KeyboardInterrupt:
+        for _, scheduler in schedulers:
+            scheduler.stop()
+    finally:
+        for warm in warm_servers:
+            warm.stop()
+        if contents is not None:
+            contents.save()
 
 
 if __name__ == '__main__':
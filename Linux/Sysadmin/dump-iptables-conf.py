@@ -2,18 +2,64 @@
 
 from __future__ import print_function
 
+import argparse
+import array
+import binascii
+import bisect
+import csv
+import functools
+import gzip
 import hashlib
-import io
+import itertools
+import json
+import multiprocessing
 import os
+import random
 import re
 import shlex
+import socket
 import subprocess
+import sys
+import time
+from collections import Counter, OrderedDict
 
 
 IPTABLES = ['iptables']
 if 'IPTABLES' in os.environ:
     IPTABLES = shlex.split(os.environ['IPTABLES'])
 
+# iptables-save lives next to iptables (ip6tables -> ip6tables-save, and
+# wrappers such as "sudo iptables" keep working); can be overridden too.
+IPTABLES_SAVE = IPTABLES[:-1] + [IPTABLES[-1] + '-save']
+if 'IPTABLES_SAVE' in os.environ:
+    IPTABLES_SAVE = shlex.split(os.environ['IPTABLES_SAVE'])
+
+
+
+def _ip6_command(command):
+    """The IPv6 twin of an IPv4 ``command`` (ip6tables-legacy for
+    iptables-legacy...), or None when its name doesn't say"""
+    head, name = os.path.split(command[-1])
+    if 'iptables' not in name:
+        return None
+    return command[:-1] + [
+        os.path.join(head, name.replace('iptables', 'ip6tables', 1))]
+
+
+# Same for IPv6, derived from the IPv4 commands unless overridden
+IP6TABLES = _ip6_command(IPTABLES)
+if 'IP6TABLES' in os.environ:
+    IP6TABLES = shlex.split(os.environ['IP6TABLES'])
+
+IP6TABLES_SAVE = None
+if IP6TABLES is not None:
+    IP6TABLES_SAVE = IP6TABLES[:-1] + [IP6TABLES[-1] + '-save']
+if 'IP6TABLES_SAVE' in os.environ:
+    IP6TABLES_SAVE = shlex.split(os.environ['IP6TABLES_SAVE'])
+
+# {family: (list command, save command)}
+COMMANDS = {4: (IPTABLES, IPTABLES_SAVE), 6: (IP6TABLES, IP6TABLES_SAVE)}
+
 TABLES = ['filter', 'nat', 'mangle', 'raw']
 
 SYSTEM_TARGET_COLORS = {
@@ -32,17 +78,67 @@ COLOR_PORT = '054'
 COLOR_NETMASK = '510'
 
 
+def _memoize(maxsize=4096):
+    """Bounded, approximately-LRU cache for single-argument functions.
+
+    Rendering the same value (chain names, ``0.0.0.0/0``, interfaces,
+    targets, ...) over and over is the bulk of the work on big rulesets.
+    Entries live in two dict "generations": hits on the old one get
+    promoted, and the old generation is dropped when the new one fills
+    up, which is much cheaper than keeping an exact recency order.
+    """
+    def decorator(func):
+        gens = [{}, {}]  # [young, old]
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            young = gens[0]
+            try:
+                return young[arg]
+            except KeyError:
+                pass
+            try:
+                value = gens[1][arg]
+            except KeyError:
+                value = func(arg)
+            if len(young) >= maxsize // 2:
+                young = {}
+                gens[:] = [young, gens[0]]
+            young[arg] = value
+            return value
+
+        return wrapper
+    return decorator
+
+
 def col256(text, fg=None, bg=None):
     if not isinstance(text, unicode):
         text = unicode(text, encoding='utf-8')
-    buf = io.StringIO()
+    prefix = u''
     if fg is not None:
-        buf.write(u'\x1b[38;5;{0:d}m'.format(_to_color(fg)))
+        prefix = u'\x1b[38;5;{0:d}m'.format(_to_color(fg))
     if bg is not None:
-        buf.write(u'\x1b[48;5;{0:d}m'.format(_to_color(bg)))
-    buf.write(text)
-    buf.write(u'\x1b[0m')
-    return buf.getvalue()
+        prefix += u'\x1b[48;5;{0:d}m'.format(_to_color(bg))
+    return prefix + text + u'\x1b[0m'
+
+
+def _cell(text, fg=None, bg=None):
+    """Like ``col256()``, but return a (visible_width, text) pair.
+
+    Table cells carry their width around, so the layout never needs to
+    strip escape sequences to measure them.
+    """
+    if not isinstance(text, unicode):
+        text = unicode(text, encoding='utf-8')
+    if fg is None and bg is None:
+        return len(text), text
+    return len(text), col256(text, fg=fg, bg=bg)
+
+
+def _join_cells(cells, sep=u''):
+    cells = list(cells)
+    return (sum(c[0] for c in cells) + len(sep) * (len(cells) - 1),
+            sep.join(c[1] for c in cells))
 
 
 def _to_color(num):
@@ -55,29 +151,57 @@ def _to_color(num):
     raise ValueError("Invalid color: {0!r}".format(num))
 
 
+_ANSI_RE = re.compile(r'\x1b\[[^m]+m')
+
+
 def strlen_no_colors(s):
     """Calculate length of a string, stripping colors"""
-    return len(re.sub(r'\x1b\[[^m]+m', '', s))
-
+    return len(_ANSI_RE.sub('', s))
+
+
+# Column widths used by --fixed-width: wider cells just push the rest
+# of their row to the right.
+FIXED_COLUMN_WIDTHS = [3, 5, 5, 12, 4, 3, 8, 8, 18, 18]
+
+
+def iter_table_lines(rows, col_widths=None):
+    """Lay out rows of (width, text) cells, yielding one line at a time.
+
+    Plain strings are accepted too, but need their colors stripped to be
+    measured.  Unless ``col_widths`` is given, all the rows are needed
+    to compute them before the first line can be yielded; with fixed
+    widths, ``rows`` can be any iterable and is consumed lazily.
+    """
+    if col_widths is None:
+        rows = [[c if isinstance(c, tuple) else (strlen_no_colors(c), c)
+                 for c in row] for row in rows]
+        col_widths = []
+        for row in rows:
+            for i, (width, _) in enumerate(row):
+                if i < len(col_widths):
+                    col_widths[i] = max(col_widths[i], width)
+                else:
+                    col_widths.append(width)
+    else:
+        rows = ([c if isinstance(c, tuple) else (strlen_no_colors(c), c)
+                 for c in row] for row in rows)
 
-def format_table(rows):
-    col_widths = {}
     for row in rows:
-        for i, col in enumerate(row):
-            col_widths[i] = max(col_widths.get(i, 0), strlen_no_colors(col))
+        parts = []
+        last = len(row) - 1
+        for i, (width, text) in enumerate(row):
+            if not isinstance(text, unicode):
+                text = unicode(text, encoding='utf-8')
+            parts.append(text)
+            if i < last:
+                padding = col_widths[i] - width if i < len(col_widths) else 0
+                parts.append(u' ' * (max(padding, 0) + 3))
+        parts.append(u'\n')
+        yield u''.join(parts)
 
-    output = io.StringIO()
-    for row in rows:
-        for i, col in enumerate(row):
-            width = col_widths[i]
-            padding = width - strlen_no_colors(col)
-            if not isinstance(col, unicode):
-                col = unicode(col, encoding='utf-8')
-            output.write(col)
-            output.write(u' ' * padding)
-            output.write(u'   ')  # Column separator
-        output.write(u'\n')
-    return output.getvalue()
+
+def format_table(rows):
+    return u''.join(iter_table_lines(rows))
 
 
 def rescale(X, A, B, C, D, force_float=False):
@@ -100,17 +224,21 @@ def _split_blocks(lines):
         yield buf
 
 
+@_memoize()
 def _colorize_chain_name(name):
     h = hashlib.sha1(name).hexdigest()
     color = int(h, 16) % 216
-    return ''.join((
-        col256('  ', bg=color),
-        col256(" {0} ".format(name), bg='335', fg=232)))
+    return _join_cells((
+        _cell('  ', bg=color),
+        _cell(" {0} ".format(name), bg='335', fg=232)))
+
+
+_CHAIN_HEADER_LINE_RE = re.compile(
+    r"^(?P<prefix>Chain\s+)(?P<name>[^\s]+)\s*\((?P<attrs>.*)\)")
 
 
 def _colorize_chain_header(line):
-    regex = r"^(?P<prefix>Chain\s+)(?P<name>[^\s]+)\s*\((?P<attrs>.*)\)"  # noqa
-    matches = re.match(regex, line.rstrip())
+    matches = _CHAIN_HEADER_LINE_RE.match(line.rstrip())
 
     data = matches.groupdict()
     data['attrs'] = data['attrs'].replace('ACCEPT', col256('ACCEPT', fg=82))
@@ -119,167 +247,157 @@ def _colorize_chain_header(line):
     return ''.join((
         u"\033[0m",
         col256(" " + data['prefix'], bg=255, fg=232), ' ',
-        _colorize_chain_name(data['name']),
+        _colorize_chain_name(data['name'])[1],
         u" ({attrs})\n"
         )).format(**data)
 
 
 def _colorize_table_header(row):
-    return ['\033[4m' + col256(col, fg=245) for col in row]
+    return [(len(col), '\033[4m' + col256(col, fg=245)) for col in row]
 
 
+_NUMBER_RE = re.compile(r'^(?P<num>[0-9]+)(?P<exp>[A-Za-z]*)$')
+_NUMBER_EXPS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                'T': 1024 ** 4}
+
+
+@_memoize()
 def _colorize_number(num):
-    exps = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
-    matches = re.match(r'^(?P<num>[0-9]+)(?P<exp>[A-Za-z]*)$', num)
-    if not matches:
-        return col256(num, fg=88)
-    numval = int(matches.groupdict()['num'])
-
-    exp = matches.groupdict()['exp']
-    if exp in exps:
-        numval *= exps[exp]
-    else:
-        return col256(num, fg=88)
+    matches = _NUMBER_RE.match(num)
+    if not matches or matches.group('exp') not in _NUMBER_EXPS:
+        return _cell(num, fg=88)
+    numval = int(matches.group('num')) * _NUMBER_EXPS[matches.group('exp')]
 
     color = int(rescale(numval, 0, 1024 ** 3, 240, 255))
     color = min(color, 255)
 
-    return col256(num, fg=color)
+    return _cell(num, fg=color)
 
 
+@_memoize()
 def _colorize_target_name(name):
+    if not name:
+        return _cell(name)
     if name in SYSTEM_TARGET_COLORS:
         col = SYSTEM_TARGET_COLORS[name]
-        return col256(" {0} ".format(name), fg=col[0], bg=col[1])
+        return _cell(" {0} ".format(name), fg=col[0], bg=col[1])
 
     return _colorize_chain_name(name)
 
 
+_PROTOCOL_COLORS = {'all': 240, 'tcp': 178, 'udp': 27, 'icmp': 28}
+
+
+@_memoize()
 def _colorize_protocol(proto):
-    if proto == 'all':
-        return col256(proto, fg=240)
-    if proto == 'tcp':
-        return col256(proto, fg=178)
-    if proto == 'udp':
-        return col256(proto, fg=27)
-    if proto == 'icmp':
-        return col256(proto, fg=28)
-    return proto
+    return _cell(proto, fg=_PROTOCOL_COLORS.get(proto))
 
 
 def _colorize_options(opt):
     if opt == '--':
-        return col256(opt, fg=240)
-    return opt
+        return _cell(opt, fg=240)
+    return _cell(opt)
 
 
+@_memoize()
 def _colorize_interface(intf):
     if intf == '*':
-        return col256(intf, fg=240)
+        return _cell(intf, fg=240)
     if intf.startswith('green'):
-        return col256(intf, fg=34)
+        return _cell(intf, fg=34)
     if intf.startswith('red'):
-        return col256(intf, fg=160)
+        return _cell(intf, fg=160)
     if intf.startswith('tun'):
-        return col256(intf, fg=27)
+        return _cell(intf, fg=27)
     if intf == 'lo':
-        return col256(intf, fg=184)
-    return intf
+        return _cell(intf, fg=184)
+    return _cell(intf)
 
 
+_ADDR_RE = re.compile(
+    r'^(?P<ip>[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})'
+    r'(?:/(?P<netmask>[0-9]+)|:(?P<port>[0-9]+))?$')
+
+
+@_memoize()
 def _colorize_addr(addr):
-    if addr == '0.0.0.0/0':
-        return col256(addr, fg=240)
-
-    m = re.match('^(?P<ip>[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})$',
-                 addr)
-    if m:
-        return col256(m.group('ip'), fg=COLOR_IP)
-
-    m = re.match('^(?P<ip>[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})$',
-                 addr)
-    if m:
-        return col256(m.group('ip'), fg=COLOR_IP)
-
-    m = re.match('^(?P<ip>[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})'
-                 '/(?P<netmask>[0-9]+)$',
-                 addr)
-    if m:
-        return ''.join((col256(m.group('ip'), fg=COLOR_IP),
-                        col256('/' + m.group('netmask'), fg=COLOR_NETMASK)))
-
-    m = re.match('^(?P<ip>[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})'
-                 ':(?P<port>[0-9]+)$',
-                 addr)
-    if m:
-        return ''.join((col256(m.group('ip'), fg=COLOR_IP),
-                        col256(':' + m.group('port'), fg=COLOR_PORT)))
+    if addr in ('0.0.0.0/0', '::/0'):
+        return _cell(addr, fg=240)
 
-    return addr
+    m = _ADDR_RE.match(addr)
+    if not m:
+        return _cell(addr)
+
+    ip, netmask, port = m.group('ip', 'netmask', 'port')
+    if netmask is not None:
+        return _join_cells((_cell(ip, fg=COLOR_IP),
+                            _cell('/' + netmask, fg=COLOR_NETMASK)))
+    if port is not None:
+        return _join_cells((_cell(ip, fg=COLOR_IP),
+                            _cell(':' + port, fg=COLOR_PORT)))
+    return _cell(ip, fg=COLOR_IP)
 
 
 def _colorize_port(port):
     # Can be: <port> or <porte:<port>
-    return ':'.join(col256(p, fg=COLOR_PORT) for p in port.split(':'))
+    return _join_cells((_cell(p, fg=COLOR_PORT) for p in port.split(':')),
+                       sep=u':')
 
 
-def _colorize_extras_token(tok):
-    if re.match(r'^[0-9]+$', tok):
-        return col256(tok, 45)
-    if re.match(r'^0x[0-9]+$', tok):
-        return col256(tok, 48)
-
-    if (tok.startswith('dpt:') or tok.startswith('dpts:') or
-            tok.startswith('spt:') or tok.startswith('spts:')):
-
-        parts = tok.split(':', 1)
-        return parts[0] + ':' + _colorize_port(parts[1])
+_EXTRAS_TOKEN_RE = re.compile(
+    r'^(?:(?P<int>[0-9]+)|(?P<hex>0x[0-9]+)'
+    r'|(?P<port_key>dpts?|spts?):(?P<port>.*)'
+    r'|(?P<addr_key>to|from):(?P<addr>.*))$')
 
-    if tok.startswith('to:') or tok.startswith('from:'):
-        parts = tok.split(':', 1)
-        return parts[0] + ':' + _colorize_addr(parts[1])
 
-    # todo: highlight:
-    # dpt:<port> dpts:<port>:<port>
-    # spt:<port> spts:<port>:<port>
-    # to:<ip> to:<ip>:<port>
-    # from:<ip> from:<ip>:<port>
-    return tok
+@_memoize()
+def _colorize_extras_token(tok):
+    m = _EXTRAS_TOKEN_RE.match(tok)
+    if m is None:
+        return _cell(tok)
+
+    kind = m.lastgroup
+    if kind == 'int':
+        return _cell(tok, 45)
+    if kind == 'hex':
+        return _cell(tok, 48)
+    if kind == 'port':
+        return _join_cells((_cell(m.group('port_key') + ':'),
+                            _colorize_port(m.group('port'))))
+    return _join_cells((_cell(m.group('addr_key') + ':'),
+                        _colorize_addr(m.group('addr'))))
 
 
 def _colorize_extras(extras):
     tokens = iter(extras.split())
-    output = io.BytesIO()
+    output = []
     for tok in tokens:
         if tok == '/*':
-            output.write('\x1b[38;5;240m')
-            output.write(tok)
+            group = [tok]
             for tok1 in tokens:
-                output.write(tok1)
+                group.append(tok1)
                 if tok1 == '*/':
-                    output.write('\x1b[0m')
                     break
+            output.append(_cell(' '.join(group), fg=240))
 
         elif tok.startswith('"'):
-            output.write('\x1b[38;5;190m')
-            output.write(tok)
-            for tok1 in tokens:
-                output.write(tok1)
-                if tok1.endswith('"'):
-                    output.write('\x1b[0m')
-                    break
-        else:
-            output.write(_colorize_extras_token(tok).encode('utf-8'))
+            group = [tok]
+            if not (len(tok) > 1 and tok.endswith('"')):
+                for tok1 in tokens:
+                    group.append(tok1)
+                    if tok1.endswith('"'):
+                        break
+            output.append(_cell(' '.join(group), fg=190))
 
-        output.write(' ')
+        else:
+            output.append(_colorize_extras_token(tok))
 
-    # extras = re.sub(r'(/\*.*\*/)', '\x1b[38;5;240m\\1\x1b[0m', extras)
-    return output.getvalue()
+    return _join_cells(output, sep=u' ')
 
 
 def _colorize_table_row(row):
     return [
-        col256(format(row[0], '>3'), fg=250, bg=238),  # num
+        _cell(format(row[0], '>3'), fg=250, bg=238),  # num
         _colorize_number(row[1]),  # pkts
         _colorize_number(row[2]),  # bytes
         _colorize_target_name(row[3]),  # target
@@ -293,26 +411,1401 @@ def _colorize_table_row(row):
     ]
 
 
-def colorize_output(lines):
-    output = io.StringIO()
-    for block in _split_blocks(lines):
-        chain_line = block[0]
-        output.write(_colorize_chain_header(chain_line))
+class Chain(object):
+    __slots__ = ('name', 'policy', 'pkts', 'bytes', 'references', 'rules')
+
+    def __init__(self, name, policy, pkts=0, bytes=0, references=0):
+        self.name = name
+        self.policy = policy  # None for user-defined chains
+        self.pkts = pkts
+        self.bytes = bytes
+        self.references = references
+        self.rules = []
+
+
+class Rule(object):
+    """A single rule, as parsed from iptables-save or --list output.
+
+    Addresses are stored as (packed integer, prefix length) pairs, so
+    they can be compared or matched without parsing text again.
+    """
+
+    __slots__ = ('table', 'chain', 'num', 'pkts', 'bytes', 'target',
+                 'proto', 'opt', 'iface_in', 'iface_out', 'family',
+                 'src', 'src_len', 'src_neg', 'dst', 'dst_len', 'dst_neg',
+                 'extras')
+
+    def __init__(self, table, chain, num, family=4):
+        self.table = table
+        self.chain = chain
+        self.num = num
+        self.pkts = 0
+        self.bytes = 0
+        self.target = ''
+        self.proto = 'all'
+        self.opt = '--'
+        self.iface_in = '*'
+        self.iface_out = '*'
+        self.family = family
+        self.src = self.dst = 0
+        self.src_len = self.dst_len = 0
+        self.src_neg = self.dst_neg = False
+        self.extras = ()
+
+    @property
+    def source(self):
+        return _format_addr(self.family, self.src, self.src_len, self.src_neg)
+
+    @source.setter
+    def source(self, value):
+        self.family, self.src, self.src_len, self.src_neg = _parse_addr(value)
+
+    @property
+    def destination(self):
+        return _format_addr(self.family, self.dst, self.dst_len, self.dst_neg)
+
+    @destination.setter
+    def destination(self, value):
+        self.family, self.dst, self.dst_len, self.dst_neg = _parse_addr(value)
+
+    def __repr__(self):
+        return '<Rule {0}:{1}:{2} -> {3}>'.format(
+            self.table, self.chain, self.num, self.target or '-')
+
+
+_ADDR_FAMILIES = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+
+def _parse_addr(text):
+    """Parse ``[!]address[/prefix]`` into (family, packed, prefix, negate)"""
+    negate = text.startswith('!')
+    if negate:
+        text = text[1:]
+    addr, _, prefix = text.partition('/')
+    family = 6 if ':' in addr else 4
+    af, bits = _ADDR_FAMILIES[family]
+    packed = int(binascii.hexlify(socket.inet_pton(af, addr)), 16)
+    if not prefix:
+        prefix = bits
+    elif '.' in prefix:  # Old-style dotted netmask
+        mask = int(binascii.hexlify(socket.inet_pton(af, prefix)), 16)
+        prefix = bin(mask).count('1')
+    else:
+        prefix = int(prefix)
+    return family, packed, prefix, negate
+
+
+def _format_addr(family, packed, prefix, negate=False):
+    af, bits = _ADDR_FAMILIES[family]
+    addr = socket.inet_ntop(
+        af, binascii.unhexlify('{0:0{1}x}'.format(packed, bits // 4)))
+    if prefix != bits:  # --list omits the prefix for single hosts
+        addr = '{0}/{1}'.format(addr, prefix)
+    if negate:
+        addr = '!' + addr
+    return addr
+
+
+# Translate iptables-save match options into the (shorter) notation
+# used by ``iptables --list``, so the extras colorizer keeps working.
+_SAVE_EXTRAS_PREFIX = {
+    '--dport': 'dpt:',
+    '--sport': 'spt:',
+    '--to-destination': 'to:',
+    '--to-source': 'to:',
+}
+_SAVE_EXTRAS_RENAME = {
+    '--dports': 'dports',
+    '--sports': 'sports',
+    '--ctstate': 'ctstate',
+    '--state': 'state',
+    '--log-prefix': 'prefix',
+    '--log-level': 'level',
+}
+# Matches that iptables --list shows only the options of
+_SAVE_UNNAMED_MATCHES = frozenset(('state', 'conntrack', 'comment'))
+
+
+def _parse_save_rule(rule, tokens):
+    tokens = iter(tokens)
+    extras = []
+    negate = ''
+    for tok in tokens:
+        if tok == '!':
+            negate = '!'
+            continue
+
+        if tok in ('-p', '--protocol'):
+            rule.proto = negate + next(tokens)
+        elif tok in ('-s', '--source'):
+            rule.source = negate + next(tokens)
+        elif tok in ('-d', '--destination'):
+            rule.destination = negate + next(tokens)
+        elif tok in ('-i', '--in-interface'):
+            rule.iface_in = negate + next(tokens)
+        elif tok in ('-o', '--out-interface'):
+            rule.iface_out = negate + next(tokens)
+        elif tok in ('-f', '--fragment'):
+            rule.opt = '!f' if negate else '-f'
+        elif tok in ('-j', '--jump', '-g', '--goto'):
+            rule.target = next(tokens)
+        elif tok in ('-m', '--match'):
+            match = next(tokens)
+            if match not in _SAVE_UNNAMED_MATCHES:
+                extras.append(match)
+        elif tok == '--comment':
+            extras.extend(('/*', next(tokens), '*/'))
+        elif tok in _SAVE_EXTRAS_PREFIX:
+            value = next(tokens)
+            prefix = _SAVE_EXTRAS_PREFIX[tok]
+            if ':' in value and prefix in ('dpt:', 'spt:'):
+                prefix = prefix[:-2] + 'ts:'
+            extras.append(negate + prefix + value)
+        elif tok in _SAVE_EXTRAS_RENAME:
+            extras.append(negate + _SAVE_EXTRAS_RENAME[tok])
+        elif ' ' in tok:
+            extras.append('"{0}"'.format(tok))
+        else:
+            extras.append(negate + tok)
+        negate = ''
+
+    rule.extras = tuple(extras)
+
+
+def _parse_counters(text):
+    pkts, bytes = text.strip('[]').split(':')
+    return int(pkts), int(bytes)
+
+
+_SAVE_TABLE_RE = re.compile(r'^\*(\S+)\s*$(.*?)^COMMIT\s*$', re.M | re.S)
+_SAVE_JUMP_RE = re.compile(r'\s-[jg]\s+(\S+)')
+
+
+def _iter_save_rule_lines(body, chains, references):
+    """Add the chains declared in the ``body`` of a table of an
+    iptables-save dump to ``chains``, and yield ``(Chain, pkts, bytes,
+    tokens)`` for each of its rules"""
+    for line in body.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if line.startswith(':'):
+            name, policy, counters = line[1:].split(None, 2)
+            pkts, bytes = _parse_counters(counters)
+            chains[name] = Chain(
+                name, None if policy == '-' else policy, pkts, bytes,
+                references[name] if policy == '-' else 0)
+            continue
+
+        pkts = bytes = 0
+        if line.startswith('['):
+            counters, line = line.split(None, 1)
+            pkts, bytes = _parse_counters(counters)
+
+        # shlex is slow, and only needed for quoted arguments
+        tokens = shlex.split(line) if '"' in line else line.split()
+        if tokens[0] not in ('-A', '--append'):
+            raise ValueError("Unsupported rule line: {0!r}".format(line))
+        yield chains[tokens[1]], pkts, bytes, tokens
+
+
+def _iter_save_rules(table, chain, rule_lines, family, num=1):
+    for _, pkts, bytes, tokens in rule_lines:
+        rule = Rule(table, chain.name, num, family)
+        rule.pkts = pkts
+        rule.bytes = bytes
+        _parse_save_rule(rule, tokens[2:])
+        yield rule
+        num += 1
+
+
+def iter_iptables_save(text, stream=True, family=4, lazy=False):
+    """Parse the output of ``iptables-save -c``, one chain at a time.
+
+    Yields ``(table, Chain)`` pairs in dump order.  With ``stream``, each
+    chain is yielded as soon as all of its rules have been read, which
+    relies on iptables-save keeping each chain's rules together, in the
+    same order the chains were declared; otherwise chains are yielded
+    when their table is complete.  With ``lazy`` too, chains are yielded
+    before their rules are read: their ``rules`` are then an iterator,
+    to be consumed before asking for the next chain.  Chain references
+    are counted with a cheap regex pass over each table before its rules
+    are parsed.  The dump doesn't say which address ``family`` it is
+    for, so it must be given (it matters for the rules without
+    addresses).
+    """
+    for m in _SAVE_TABLE_RE.finditer(text):
+        table, body = m.group(1), m.group(2)
+        references = Counter(_SAVE_JUMP_RE.findall(body))
+        chains = OrderedDict()
+        rule_lines = _iter_save_rule_lines(body, chains, references)
+        pending = None  # Declared, not yielded nor current yet
+        current = None
+
+        for chain, group in itertools.groupby(rule_lines, lambda x: x[0]):
+            if stream:
+                if pending is None:  # The declarations have been read
+                    pending = chains.copy()
+                # Anything declared before this chain is complete
+                if current is not None and not lazy:
+                    yield table, current
+                if chain.name not in pending:
+                    raise ValueError("Rules for chain {0} are not contiguous"
+                                     .format(chain.name))
+                while True:
+                    name, current = pending.popitem(last=False)
+                    if name == chain.name:
+                        break
+                    yield table, current
+
+            rules = _iter_save_rules(table, chain, group, family,
+                                     len(chain.rules) + 1)
+            if stream and lazy:
+                chain.rules = rules
+                yield table, chain
+            else:
+                chain.rules.extend(rules)
+
+        if not stream or pending is None:
+            pending = chains
+        elif current is not None and not lazy:
+            yield table, current
+        for chain in pending.values():
+            yield table, chain
+
+
+def parse_iptables_save(text, family=4):
+    """Parse the output of ``iptables-save -c`` (or ``ip6tables-save -c``
+    with ``family`` 6).
+
+    Returns an ordered ``{table: {chain_name: Chain}}`` mapping, in the
+    same order the tables / chains appear in the dump.
+    """
+    tables = OrderedDict()
+    for table, chain in iter_iptables_save(text, stream=False,
+                                           family=family):
+        tables.setdefault(table, OrderedDict())[chain.name] = chain
+    return tables
+
+
+_CHAIN_HEADER_RE = re.compile(
+    r'^Chain\s+(?P<name>\S+)\s*\('
+    r'(?:policy\s+(?P<policy>\S+)\s+(?P<pkts>\S+)\s+packets,\s+'
+    r'(?P<bytes>\S+)\s+bytes|(?P<refs>[0-9]+)\s+references)')
+
+
+def _parse_list_header(line):
+    m = _CHAIN_HEADER_RE.match(line)
+    if m is None:
+        raise ValueError("Invalid chain header: {0!r}".format(line))
+    return Chain(
+        m.group('name'), m.group('policy'),
+        _parse_counter(m.group('pkts') or '0'),
+        _parse_counter(m.group('bytes') or '0'),
+        int(m.group('refs') or 0))
+
+
+def _iter_list_rules(table, chain, columns, lines, family):
+    # Rules without a target leave that column blank
+    target_col = columns.find('target')
+    for line in lines:
+        row = line.split()
+        if line[target_col:target_col + 1].isspace():
+            row.insert(3, '')
+        if row[5] not in ('--', '-f', '!f'):  # Blank with ip6tables
+            row.insert(5, '--')
+        rule = Rule(table, chain.name, int(row[0]), family)
+        rule.pkts = _parse_counter(row[1])
+        rule.bytes = _parse_counter(row[2])
+        rule.target = row[3]
+        rule.proto = row[4]
+        rule.opt = row[5]
+        rule.iface_in = row[6]
+        rule.iface_out = row[7]
+        rule.source = row[8]
+        rule.destination = row[9]
+        rule.extras = tuple(row[10:])
+        yield rule
+
+
+def _parse_list_block(block, table, family):
+    chain = _parse_list_header(block[0])
+    chain.rules.extend(
+        _iter_list_rules(table, chain, block[1], block[2:], family))
+    return chain
+
+
+def iter_iptables_list(lines, table, family=None, lazy=False):
+    """Parse ``iptables -t <table> --list -v -n --line-numbers`` output
+    lines, yielding ``(table, Chain)`` pairs as each block is read.
+
+    With ``lazy``, chains are yielded as soon as their header has been
+    read, with ``rules`` an iterator over the lines that follow, to be
+    consumed before asking for the next chain.
+    """
+    if family is None:
+        family = 6 if 'ip6tables' in IPTABLES[-1] else 4
+    if not lazy:
+        for block in _split_blocks(lines):
+            yield table, _parse_list_block(block, table, family)
+        return
+
+    lines = iter(lines)
+    for line in lines:
+        if line.strip() == '':
+            continue
+        chain = _parse_list_header(line)
+        chain.rules = _iter_list_rules(
+            table, chain, next(lines),
+            itertools.takewhile(lambda x: x.strip() != '', lines), family)
+        yield table, chain
+        for _ in chain.rules:  # Skip what wasn't read
+            pass
+
+
+def parse_iptables_list(text, table, family=None):
+    """Parse the output of ``iptables -t <table> --list -v -n --line-numbers``
+
+    Returns a ``{table: {chain_name: Chain}}`` mapping, same as
+    ``parse_iptables_save()``.
+    """
+    chains = OrderedDict()
+    for _, chain in iter_iptables_list(text.splitlines(), table, family):
+        chains[chain.name] = chain
+    return {table: chains}
+
+
+_PARSE_CACHE = OrderedDict()
+_PARSE_CACHE_SIZE = 8
+
+
+def parse_ruleset(text, table=None, family=None):
+    """Parse a ruleset dump, reusing earlier results for identical text.
+
+    ``text`` is ``iptables-save -c`` output, or ``--list`` output for
+    ``table`` when that is given, for ``family`` (IPv4 by default for
+    save output).  The returned objects are shared between callers, and
+    must not be modified.
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    if table is None and family is None:
+        family = 4
+    key = (table, family, hashlib.sha1(text).digest())
+    try:
+        tables = _PARSE_CACHE.pop(key)
+    except KeyError:
+        if table is None:
+            tables = parse_iptables_save(text, family)
+        else:
+            tables = parse_iptables_list(text, table, family)
+        while len(_PARSE_CACHE) >= _PARSE_CACHE_SIZE:
+            _PARSE_CACHE.popitem(last=False)
+    _PARSE_CACHE[key] = tables
+    return tables
+
+
+_COUNTER_UNITS = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3,
+                  'T': 1000 ** 4}
+
+
+def _parse_counter(text):
+    if text[-1:].isdigit():
+        return int(text)
+    return int(text[:-1]) * _COUNTER_UNITS[text[-1]]
+
 
-        table_header = block[1].split()
-        table_header = _colorize_table_header(table_header)
-        table_rows = [x.split() for x in block[2:]]
-        table_rows = [_colorize_table_row(t) for t in table_rows]
-        output.write(format_table([table_header] + table_rows))
+def _format_counter(number):
+    """Format a counter the same way ``iptables --list -v`` does"""
+    for suffix in ('', 'K', 'M', 'G'):
+        if number <= (99999 if suffix == '' else 9999):
+            return '{0}{1}'.format(number, suffix)
+        number = (number + 500) // 1000
+    return '{0}T'.format(number)
 
-        output.write(u'\n')
 
-    return output.getvalue()
+def _chain_header_line(chain):
+    if chain.policy is None:
+        return 'Chain {0} ({1} references)'.format(
+            chain.name, chain.references)
+    return 'Chain {0} (policy {1} {2} packets, {3} bytes)'.format(
+        chain.name, chain.policy,
+        _format_counter(chain.pkts), _format_counter(chain.bytes))
 
 
-for table in TABLES:
-    output = subprocess.check_output(IPTABLES + [
-        '-t', table, '--list', '--line-numbers', '-v', '-n'])
-    print("\033[0m\033[48;5;{0}m\033[K Table: \033[1m{1} \033[0m\n"
-          .format(_to_color('200'), table))
-    print(colorize_output(iter(output.splitlines())).encode('utf-8'))
+def _rule_as_row(rule):
+    return [
+        str(rule.num),
+        _format_counter(rule.pkts),
+        _format_counter(rule.bytes),
+        rule.target,
+        rule.proto,
+        rule.opt,
+        rule.iface_in,
+        rule.iface_out,
+        rule.source,
+        rule.destination,
+    ] + list(rule.extras)
+
+
+def iter_colorized_chains(chains, col_widths=None):
+    """Colorize an iterable of ``Chain`` objects, yielding output lines.
+
+    Each chain's rows are laid out (and its lines yielded) before the
+    next chain is consumed; see ``iter_table_lines()`` for
+    ``col_widths``.
+    """
+    table_header = _colorize_table_header([
+        'num', 'pkts', 'bytes', 'target', 'prot', 'opt', 'in', 'out',
+        'source', 'destination'])
+
+    for chain in chains:
+        yield _colorize_chain_header(_chain_header_line(chain))
+        table_rows = (_colorize_table_row(_rule_as_row(r))
+                      for r in chain.rules)
+        if col_widths is None:
+            table_rows = list(table_rows)
+        rows = itertools.chain([table_header], table_rows)
+        for line in iter_table_lines(rows, col_widths):
+            yield line
+        yield u'\n'
+
+
+def colorize_chains(chains):
+    """Colorize a ``{chain_name: Chain}`` mapping, as returned (per table)
+    by ``parse_ruleset()``"""
+    return u''.join(iter_colorized_chains(chains.values()))
+
+
+def colorize_output(lines, table='filter'):
+    """Colorize ``iptables --list -v -n --line-numbers`` output lines"""
+    tables = parse_ruleset('\n'.join(lines), table=table)
+    return colorize_chains(tables[table])
+
+
+def _table_banner(table, family=None):
+    if family == 6:
+        table = '{0} (IPv6)'.format(table)
+    return (u"\033[0m\033[48;5;{0}m\033[K Table: \033[1m{1} \033[0m\n\n"
+            .format(_to_color('200'), table))
+
+
+def _write_streaming(items, col_widths=None, family=None):
+    """Render ``(table, Chain)`` pairs as they come, flushing stdout
+    after each chain (after each line with fixed ``col_widths``, as the
+    chains' rules can then still be coming)"""
+    for table, group in itertools.groupby(items, key=lambda x: x[0]):
+        sys.stdout.write(_table_banner(table, family).encode('utf-8'))
+        for _, chain in group:
+            for line in iter_colorized_chains([chain], col_widths):
+                sys.stdout.write(line.encode('utf-8'))
+                if col_widths is not None:
+                    sys.stdout.flush()
+            sys.stdout.flush()
+        sys.stdout.write('\n')
+
+
+def _ordered_tables(tables):
+    ordered = [t for t in TABLES if t in tables]
+    return ordered + [t for t in tables if t not in TABLES]
+
+
+def _list_command(family, table):
+    return COMMANDS[family][0] + [
+        '-t', table, '--list', '--line-numbers', '-v', '-n']
+
+
+def _iter_list_command(family, table, lazy=False):
+    command = _list_command(family, table)
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    lines = iter(proc.stdout.readline, '')
+    for item in iter_iptables_list(lines, table, family, lazy):
+        yield item
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, command)
+
+
+def _fetch_save(family):
+    """One ``iptables-save`` snapshot of all tables, split by table.
+
+    This takes the xtables lock (and walks the kernel ruleset) only once,
+    instead of once per table.
+    """
+    output = subprocess.check_output(COMMANDS[family][1] + ['-c'])
+    sections = OrderedDict(
+        (m.group(1), m.group(0)) for m in _SAVE_TABLE_RE.finditer(output))
+    return [(family, table, sections[table])
+            for table in _ordered_tables(sections)]
+
+
+def _fetch_list(family):
+    return [(family, table,
+             subprocess.check_output(_list_command(family, table)))
+            for table in TABLES]
+
+
+def _iter_table_lines(job):
+    family, table, text, backend, col_widths = job
+    if backend == 'save':
+        chains = parse_ruleset(text, family=family)[table]
+    else:
+        chains = parse_ruleset(text, table=table, family=family)[table]
+    yield _table_banner(table, family)
+    for line in iter_colorized_chains(chains.values(), col_widths):
+        yield line
+    yield u'\n'
+
+
+def _render_table(job):
+    """Render a whole table in a pool worker, to send it back in one
+    piece"""
+    return u''.join(_iter_table_lines(job)).encode('utf-8')
+
+
+def dump(families=(4,), backend='save', stream=False, col_widths=None,
+         jobs=None):
+    """Dump the rules of all tables, for each of ``families``.
+
+    With ``jobs``, commands run (and tables get rendered) on a pool of
+    that many processes; output order stays the same.  When streaming
+    without a pool, tables are shown in dump order and each chain is
+    printed as soon as it has been read; with fixed ``col_widths``, each
+    rule is.
+    """
+    if stream and not jobs:
+        lazy = col_widths is not None
+        for family in families:
+            if backend == 'save':
+                output = subprocess.check_output(COMMANDS[family][1] + ['-c'])
+                items = iter_iptables_save(output, family=family, lazy=lazy)
+            else:
+                items = itertools.chain.from_iterable(
+                    _iter_list_command(family, table, lazy)
+                    for table in TABLES)
+            _write_streaming(items, col_widths, family)
+        return
+
+    fetch = _fetch_save if backend == 'save' else _fetch_list
+    pool = multiprocessing.Pool(jobs) if jobs else None
+    try:
+        if pool is not None:
+            fetched = pool.map(fetch, families)
+        else:
+            fetched = [fetch(family) for family in families]
+
+        render_jobs = [(family, table, text, backend, col_widths)
+                       for tables in fetched
+                       for family, table, text in tables]
+        if pool is not None:
+            for output in pool.imap(_render_table, render_jobs):
+                sys.stdout.write(output)
+                sys.stdout.flush()
+        else:
+            for job in render_jobs:
+                for line in _iter_table_lines(job):
+                    sys.stdout.write(line.encode('utf-8'))
+                sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+_SAVE_CHAIN_COUNTERS_RE = re.compile(r'^:(\S+)\s+\S+\s+\[([0-9]+):([0-9]+)\]')
+_SAVE_RULE_COUNTERS_RE = re.compile(
+    r'^\[([0-9]+):([0-9]+)\]\s+-A\s+(\S+)\s*(.*)$')
+_SAVE_ANY_COUNTERS_RE = re.compile(r'\[[0-9]+:[0-9]+\]')
+
+
+class CounterSnapshot(object):
+    """Packet / byte counters of every rule in an ``iptables-save -c``
+    dump, taken at ``timestamp``.
+
+    Counters are kept in flat arrays; rules are identified by a hash of
+    their table, chain and specification (plus an occurrence number, for
+    duplicates), so that they can be matched between snapshots even if
+    other rules were inserted in the meantime.  Chain policies are
+    stored with a rule number of ``None``.
+    """
+
+    __slots__ = ('timestamp', 'keys', 'positions', 'ids', 'index',
+                 'pkts', 'bytes')
+
+    def __init__(self, text, timestamp=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.keys = []  # (table, chain, num)
+        self.ids = []  # Rule content hashes
+        self.pkts = array.array('L')
+        self.bytes = array.array('L')
+
+        for m in _SAVE_TABLE_RE.finditer(text):
+            table = m.group(1)
+            numbers = Counter()
+            occurrences = Counter()
+            for line in m.group(2).splitlines():
+                rm = _SAVE_RULE_COUNTERS_RE.match(line)
+                if rm is not None:
+                    pkts, bytes, chain, spec = rm.groups()
+                    numbers[chain] += 1
+                    occurrences[chain, spec] += 1
+                    self._add((table, chain, numbers[chain]),
+                              hash((table, chain, spec,
+                                    occurrences[chain, spec])),
+                              pkts, bytes)
+                    continue
+
+                cm = _SAVE_CHAIN_COUNTERS_RE.match(line)
+                if cm is not None:
+                    chain, pkts, bytes = cm.groups()
+                    self._add((table, chain, None),
+                              hash((table, chain, None)), pkts, bytes)
+
+        self.positions = dict((k, i) for i, k in enumerate(self.keys))
+        self.index = dict((h, i) for i, h in enumerate(self.ids))
+
+    def _add(self, key, rule_id, pkts, bytes):
+        self.keys.append(key)
+        self.ids.append(rule_id)
+        self.pkts.append(int(pkts))
+        self.bytes.append(int(bytes))
+
+    def rates(self, previous):
+        """Per-second (pkts, bytes) rates since ``previous``, as arrays
+        aligned with ``self.keys``"""
+        elapsed = (self.timestamp - previous.timestamp) or 1e-9
+        old_pkts, old_bytes = previous.pkts, previous.bytes
+        pps = array.array('d', itertools.repeat(0.0, len(self.keys)))
+        bps = array.array('d', pps)
+        for i, rule_id in enumerate(self.ids):
+            j = previous.index.get(rule_id)
+            if j is None:
+                continue  # New rule: no rate yet
+            dp = self.pkts[i] - old_pkts[j]
+            db = self.bytes[i] - old_bytes[j]
+            if dp < 0 or db < 0:  # Counters were zeroed
+                dp, db = self.pkts[i], self.bytes[i]
+            pps[i] = dp / elapsed
+            bps[i] = db / elapsed
+        return pps, bps
+
+
+def _strip_counters(text):
+    """Zero all counters in a dump, so that the rest of it can be parsed
+    once and then served from the ``parse_ruleset()`` cache"""
+    return _SAVE_ANY_COUNTERS_RE.sub('[0:0]', text)
+
+
+def _colorize_rate(rate, maximum):
+    color = int(rescale(min(rate, maximum), 0, maximum, 240, 255,
+                        force_float=True))
+    return _cell(_format_counter(int(round(rate))), fg=color)
+
+
+def iter_rate_lines(text, snapshot, previous, family=None, col_widths=None):
+    """Render rules from ``text`` with pkts/s and bytes/s columns,
+    measured between the ``previous`` and ``snapshot`` counters.
+
+    The color ramp goes up to the busiest rule in the ruleset.
+    """
+    tables = parse_ruleset(_strip_counters(text), family=family)
+    pps, bps = snapshot.rates(previous)
+    max_pps = max(pps) if len(pps) else 0
+    max_bps = max(bps) if len(bps) else 0
+    max_pps, max_bps = max_pps or 1, max_bps or 1
+    table_header = _colorize_table_header([
+        'num', 'pkts/s', 'bytes/s', 'target', 'prot', 'opt', 'in', 'out',
+        'source', 'destination'])
+
+    for table in _ordered_tables(tables):
+        yield _table_banner(table, family)
+        for chain in tables[table].values():
+            i = snapshot.positions.get((table, chain.name, None))
+            if chain.policy is None or i is None:
+                header = _chain_header_line(chain)
+            else:
+                header = 'Chain {0} (policy {1} {2} packets/s, {3} bytes/s)' \
+                    .format(chain.name, chain.policy,
+                            _format_counter(int(round(pps[i]))),
+                            _format_counter(int(round(bps[i]))))
+            yield _colorize_chain_header(header)
+
+            rows = [table_header]
+            for rule in chain.rules:
+                row = _colorize_table_row(_rule_as_row(rule))
+                i = snapshot.positions[table, chain.name, rule.num]
+                row[1] = _colorize_rate(pps[i], max_pps)
+                row[2] = _colorize_rate(bps[i], max_bps)
+                rows.append(row)
+            for line in iter_table_lines(rows, col_widths):
+                yield line
+            yield u'\n'
+
+
+def watch_rates(interval, families=(4,), watch=False, col_widths=None):
+    """Sample counters every ``interval`` seconds, and show per-rule
+    rates; just once, or refreshing the screen with ``watch``"""
+    def _sample(family):
+        text = subprocess.check_output(COMMANDS[family][1] + ['-c'])
+        return text, CounterSnapshot(text)
+
+    previous = dict((family, _sample(family)[1]) for family in families)
+    while True:
+        time.sleep(interval)
+        output = []
+        for family in families:
+            text, snapshot = _sample(family)
+            output.extend(iter_rate_lines(
+                text, snapshot, previous[family], family, col_widths))
+            previous[family] = snapshot
+
+        if watch:
+            sys.stdout.write('\033[H\033[2J')
+        sys.stdout.write(u''.join(output).encode('utf-8'))
+        sys.stdout.flush()
+        if not watch:
+            break
+
+
+# Targets after which a packet stops traversing the table
+TERMINATING_TARGETS = frozenset((
+    'ACCEPT', 'DROP', 'REJECT', 'DNAT', 'SNAT', 'MASQUERADE', 'REDIRECT',
+    'NETMAP', 'QUEUE', 'NFQUEUE', 'TPROXY'))
+
+# Rules with one of these targets can swap places when they have the
+# same target: whichever matches first, the outcome is the same.
+_SWAPPABLE_TARGETS = frozenset(('ACCEPT', 'DROP', 'RETURN'))
+
+
+class ChainProfile(object):
+    """Estimated traffic flow through a chain.
+
+    ``reaching[i]`` is how many packets got to (and were evaluated by)
+    rule ``i + 1``; ``depth`` is the average number of rules packets
+    were evaluated against before entering the chain.
+    """
+
+    __slots__ = ('chain', 'entering', 'reaching', 'returned', 'depth')
+
+    def __init__(self, chain):
+        self.chain = chain
+        self.entering = 0
+        self.reaching = []
+        self.returned = 0
+        self.depth = 0.0
+
+    @property
+    def evaluations(self):
+        return sum(self.reaching)
+
+
+def profile_chains(chains):
+    """Estimate, from rule counters, how packets flow through the
+    ``{chain_name: Chain}`` mapping of one table.
+
+    Built-in chains are walked backwards from their policy counter
+    (packets that got to the end); user chains forwards, from the
+    packets of the rules jumping to them.  Returns a
+    ``{chain_name: ChainProfile}`` mapping.
+    """
+    callers = dict((name, []) for name in chains)
+    for chain in chains.values():
+        for rule in chain.rules:
+            if rule.target in callers:
+                callers[rule.target].append((chain, rule))
+
+    profiles = {}
+
+    def _terminated(rule):
+        if rule.target in TERMINATING_TARGETS or rule.target == 'RETURN':
+            return rule.pkts
+        if rule.target in chains:
+            sub = _profile(rule.target)
+            if sub.entering:
+                return rule.pkts * (1 - float(sub.returned) / sub.entering)
+        return 0
+
+    def _profile(name):
+        if name in profiles:
+            return profiles[name]
+        chain = chains[name]
+        profile = profiles[name] = ChainProfile(chain)
+
+        if chain.policy is not None:
+            reaching = chain.pkts
+            for rule in reversed(chain.rules):
+                reaching += _terminated(rule)
+                profile.reaching.append(reaching)
+            profile.reaching.reverse()
+            profile.entering = reaching
+            return profile
+
+        # The depth first: chains called from the walk below need it
+        weight = sum(r.pkts for _, r in callers[name])
+        if callers[name]:
+            profile.depth = sum(
+                (_profile(c.name).depth + r.num) * (r.pkts if weight else 1)
+                for c, r in callers[name]
+            ) / float(weight or len(callers[name]))
+
+        reaching = profile.entering = weight
+        for rule in chain.rules:
+            profile.reaching.append(max(reaching, 0))
+            reaching -= _terminated(rule)
+        profile.returned = max(reaching, 0) + sum(
+            r.pkts for r in chain.rules if r.target == 'RETURN')
+        return profile
+
+    for name in chains:
+        _profile(name)
+    return profiles
+
+
+def _prefixes_overlap(family, a, a_len, b, b_len):
+    bits = _ADDR_FAMILIES[family][1]
+    shift = bits - min(a_len, b_len)
+    return (a >> shift) == (b >> shift)
+
+
+def _rules_disjoint(a, b):
+    """Whether no packet can match both rules (conservatively)"""
+    if (a.proto != b.proto and 'all' not in (a.proto, b.proto) and
+            not any(p.startswith('!') for p in (a.proto, b.proto))):
+        return True
+    if a.family == b.family:
+        if not (a.src_neg or b.src_neg) and not _prefixes_overlap(
+                a.family, a.src, a.src_len, b.src, b.src_len):
+            return True
+        if not (a.dst_neg or b.dst_neg) and not _prefixes_overlap(
+                a.family, a.dst, a.dst_len, b.dst, b.dst_len):
+            return True
+    for x, y in ((a.iface_in, b.iface_in), (a.iface_out, b.iface_out)):
+        if x != y and not any(i == '*' or i.endswith('+') or
+                              i.startswith('!') for i in (x, y)):
+            return True
+    return False
+
+
+def _can_swap(a, b):
+    if a.target == b.target and a.target in _SWAPPABLE_TARGETS:
+        return True
+    return _rules_disjoint(a, b)
+
+
+def suggest_moves(chain, rules):
+    """Suggest moving each of ``rules`` (hot rules of ``chain``) above
+    the less-busy rules right before it, when that is safe.
+
+    Yields ``(rule, above_rule, saved_evaluations)`` tuples.
+    """
+    for rule in rules:
+        index = rule.num - 1
+        saved = 0
+        above = None
+        for other in reversed(chain.rules[:index]):
+            if other.pkts >= rule.pkts or not _can_swap(rule, other):
+                break
+            saved += rule.pkts - other.pkts
+            above = other
+        if above is not None:
+            yield rule, above, saved
+
+
+def _rule_matches_summary(rule):
+    return ' '.join(x for x in _rule_as_row(rule)[4:]
+                    if x not in ('all', '--', '*', '0.0.0.0/0', '::/0'))
+
+
+def iter_profile_lines(tables, family=None, top=20):
+    """Report the rules whose packets paid the most rule evaluations to
+    reach them, per-chain load, and possible reorderings"""
+    costs = []
+    profiles_by_table = OrderedDict()
+    for table in _ordered_tables(tables):
+        profiles = profiles_by_table[table] = profile_chains(tables[table])
+        for profile in profiles.values():
+            for rule in profile.chain.rules:
+                cost = rule.pkts * (profile.depth + rule.num - 1)
+                if cost:
+                    costs.append((cost, table, profile, rule))
+    costs.sort(key=lambda x: x[0], reverse=True)
+    costs = costs[:top]
+
+    title = u'Hot rules' if family != 6 else u'Hot rules (IPv6)'
+    yield col256(u' {0} '.format(title), bg=255, fg=232) + u'\n\n'
+    rows = [_colorize_table_header(['rank', 'rule', 'pkts', 'depth',
+                                    'evaluations', 'rule'])]
+    for rank, (cost, table, profile, rule) in enumerate(costs, 1):
+        rows.append([
+            _cell(format(rank, '>3'), fg=250, bg=238),
+            _cell('{0}:{1}:{2}'.format(table, rule.chain, rule.num)),
+            _colorize_number(_format_counter(rule.pkts)),
+            _cell('{0:.1f}'.format(profile.depth + rule.num - 1)),
+            _colorize_number(_format_counter(int(cost))),
+            _join_cells((_colorize_target_name(rule.target),
+                         _cell(_rule_matches_summary(rule))), sep=u' ')])
+    for line in iter_table_lines(rows):
+        yield line
+
+    yield u'\n' + col256(u' Chain load ', bg=255, fg=232) + u'\n\n'
+    rows = [_colorize_table_header(['chain', 'rules', 'entering',
+                                    'evaluations', 'evals/pkt'])]
+    load = sorted(((p.evaluations, t, p)
+                   for t, profiles in profiles_by_table.items()
+                   for p in profiles.values()),
+                  key=lambda x: x[0], reverse=True)
+    for evaluations, table, profile in load[:top]:
+        entering = int(profile.entering)
+        rows.append([
+            _join_cells((_cell(table + ':'),
+                         _colorize_chain_name(profile.chain.name))),
+            _cell(str(len(profile.chain.rules))),
+            _colorize_number(_format_counter(entering)),
+            _colorize_number(_format_counter(int(evaluations))),
+            _cell('{0:.1f}'.format(evaluations / float(entering or 1)))])
+    for line in iter_table_lines(rows):
+        yield line
+
+    yield u'\n' + col256(u' Suggested moves ', bg=255, fg=232) + u'\n\n'
+    by_chain = OrderedDict()
+    for _, table, profile, rule in costs:
+        by_chain.setdefault((table, profile.chain), []).append(rule)
+    for (table, chain), rules in by_chain.items():
+        rules.sort(key=lambda r: r.num)
+        for rule, above, saved in suggest_moves(chain, rules):
+            yield (u'{0}:{1}: move rule {2} ({3}) above rule {4}, '
+                   u'saving ~{5} evaluations\n'.format(
+                       table, chain.name, rule.num,
+                       ' '.join((rule.target, _rule_matches_summary(rule))),
+                       above.num, _format_counter(int(saved))))
+    yield u'\n'
+
+
+def profile_rules(families=(4,), top=20):
+    for family in families:
+        text = subprocess.check_output(COMMANDS[family][1] + ['-c'])
+        tables = parse_iptables_save(text, family)
+        for line in iter_profile_lines(tables, family, top):
+            sys.stdout.write(line.encode('utf-8'))
+
+
+RECORD_FIELDS = (
+    'family', 'table', 'chain', 'num', 'pkts', 'bytes', 'target', 'proto',
+    'opt', 'in', 'out', 'src', 'src_prefix', 'src_negated', 'dst',
+    'dst_prefix', 'dst_negated', 'sport', 'dport', 'extras')
+
+_PORT_TOKENS = {'spt': 'sport', 'spts': 'sport', 'sports': 'sport',
+                'dpt': 'dport', 'dpts': 'dport', 'dports': 'dport'}
+
+
+def _rule_ports(rule):
+    """Extract (sport, dport) from the rule extras, as strings"""
+    ports = {}
+    tokens = iter(rule.extras)
+    for tok in tokens:
+        key, sep, value = tok.partition(':')
+        if key in _PORT_TOKENS:
+            if not sep:  # multiport: "dports 22,80"
+                value = next(tokens, '')
+            ports[_PORT_TOKENS[key]] = value
+    return ports.get('sport'), ports.get('dport')
+
+
+def rule_record(rule):
+    """Flatten a ``Rule`` into a tuple of ``RECORD_FIELDS`` values"""
+    bits = _ADDR_FAMILIES[rule.family][1]
+    src = _format_addr(rule.family, rule.src, bits)
+    dst = _format_addr(rule.family, rule.dst, bits)
+    sport, dport = _rule_ports(rule)
+    return (rule.family, rule.table, rule.chain, rule.num, rule.pkts,
+            rule.bytes, rule.target, rule.proto, rule.opt, rule.iface_in,
+            rule.iface_out, src, rule.src_len, rule.src_neg, dst,
+            rule.dst_len, rule.dst_neg, sport, dport, ' '.join(rule.extras))
+
+
+def export_rules(families=(4,), backend='save', fmt='jsonl', out=None):
+    """Write one record per rule, as JSON lines or CSV.
+
+    Chains are parsed one at a time and nothing gets colorized; records
+    go straight to a buffered writer.
+    """
+    if out is None:
+        out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb', 1 << 16)
+
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(RECORD_FIELDS)
+        write_record = writer.writerow
+    else:
+        dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+        def write_record(record):
+            out.write(dumps(OrderedDict(zip(RECORD_FIELDS, record))))
+            out.write('\n')
+
+    try:
+        for family in families:
+            if backend == 'save':
+                output = subprocess.check_output(COMMANDS[family][1] + ['-c'])
+                items = iter_iptables_save(output, family=family)
+            else:
+                items = itertools.chain.from_iterable(
+                    _iter_list_command(family, table) for table in TABLES)
+            for _, chain in items:
+                for rule in chain.rules:
+                    write_record(rule_record(rule))
+    finally:
+        out.flush()
+
+
+def rule_spec(rule):
+    """Everything a rule matches on and does, but not where it sits in
+    its chain nor its counters"""
+    return (rule.target, rule.proto, rule.opt, rule.iface_in,
+            rule.iface_out, rule.family, rule.src, rule.src_len,
+            rule.src_neg, rule.dst, rule.dst_len, rule.dst_neg, rule.extras)
+
+
+def save_snapshot(path, families=(4,)):
+    """Store ``iptables-save -c`` dumps for ``families`` in a gzipped
+    JSON file, to be compared later with ``--diff``"""
+    snapshot = {
+        'timestamp': time.time(),
+        'dumps': dict(
+            (str(family),
+             subprocess.check_output(COMMANDS[family][1] + ['-c']))
+            for family in families),
+    }
+    with gzip.open(path, 'wb') as fp:
+        json.dump(snapshot, fp)
+
+
+def load_snapshot(path):
+    """Load a snapshot file, returning ``(timestamp, {family: dump})``"""
+    with gzip.open(path, 'rb') as fp:
+        snapshot = json.load(fp)
+    return snapshot['timestamp'], dict(
+        (int(family), text.encode('utf-8'))
+        for family, text in snapshot['dumps'].items())
+
+
+def _longest_increasing(seq):
+    """Indexes of a longest strictly increasing subsequence of ``seq``,
+    in O(n log n)"""
+    tails = []  # tails[k]: index ending the best subsequence of length k+1
+    tail_values = []
+    parents = [None] * len(seq)
+    for i, value in enumerate(seq):
+        k = bisect.bisect_left(tail_values, value)
+        if k:
+            parents[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+
+    result = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.add(i)
+        i = parents[i]
+    return result
+
+
+def _keyed_rules(chain):
+    occurrences = Counter()
+    keyed = OrderedDict()
+    for rule in chain.rules:
+        spec = rule_spec(rule)
+        occurrences[spec] += 1
+        keyed[spec, occurrences[spec]] = rule
+    return keyed
+
+
+def diff_chain(old, new):
+    """Compare two versions of a chain (either can be ``None``).
+
+    Rules are matched by content, not by number, so an inserted rule
+    only shows up as an addition.  Returns a list of ``(status,
+    old_rule, new_rule)`` in new chain order (removed rules last),
+    where status is one of ``'+'``, ``'-'``, ``'~'`` (moved) or
+    ``'='``.
+    """
+    old_rules = _keyed_rules(old) if old is not None else {}
+    new_rules = _keyed_rules(new) if new is not None else {}
+
+    common = [k for k in new_rules if k in old_rules]
+    old_positions = [old_rules[k].num for k in common]
+    in_order = _longest_increasing(old_positions)
+    moved = set(k for i, k in enumerate(common) if i not in in_order)
+
+    result = []
+    for key, rule in new_rules.items():
+        if key not in old_rules:
+            result.append(('+', None, rule))
+        else:
+            result.append(('~' if key in moved else '=',
+                           old_rules[key], rule))
+    for key, rule in old_rules.items():
+        if key not in new_rules:
+            result.append(('-', rule, None))
+    return result
+
+
+_DIFF_MARKERS = {'+': 34, '-': 160, '~': 178, '=': 240}
+
+
+def _colorize_delta(value):
+    if not value:
+        return _cell('0', fg=240)
+    sign = '+' if value > 0 else '-'
+    return _join_cells((_cell(sign),
+                        _colorize_number(_format_counter(abs(value)))))
+
+
+def iter_diff_lines(old_tables, new_tables, family=None, counters=True):
+    """Render the differences between two parsed rulesets.
+
+    Unchanged rules are only shown (with ``counters``) when their
+    counters changed.
+    """
+    table_header = _colorize_table_header([
+        '', 'num', 'pkts', 'bytes', 'target', 'prot', 'opt', 'in', 'out',
+        'source', 'destination'])
+
+    tables = list(_ordered_tables(new_tables))
+    tables += [t for t in _ordered_tables(old_tables) if t not in new_tables]
+    for table in tables:
+        old_chains = old_tables.get(table, {})
+        new_chains = new_tables.get(table, {})
+        names = list(new_chains)
+        names += [n for n in old_chains if n not in new_chains]
+
+        banner = False
+        for name in names:
+            old, new = old_chains.get(name), new_chains.get(name)
+            rows = []
+            for status, old_rule, new_rule in diff_chain(old, new):
+                if status in '=~':
+                    dp = new_rule.pkts - old_rule.pkts
+                    db = new_rule.bytes - old_rule.bytes
+                    if status == '=' and not (counters and (dp or db)):
+                        continue
+
+                row = _rule_as_row(new_rule or old_rule)
+                if status == '~':
+                    row[0] = '{0}->{1}'.format(old_rule.num, new_rule.num)
+                cells = _colorize_table_row(row)
+                if status in '=~':
+                    cells[1] = _colorize_delta(dp)
+                    cells[2] = _colorize_delta(db)
+                cells[0] = _cell(format(row[0], '>3'), fg=250, bg=238)
+                rows.append([_cell(status, fg=_DIFF_MARKERS[status])] + cells)
+
+            if old is None:
+                header = u'{0} (added)'
+            elif new is None:
+                header = u'{0} (removed)'
+            elif old.policy != new.policy:
+                header = u'{{0}} (policy {0} -> {1})'.format(
+                    old.policy, new.policy)
+            elif rows:
+                header = u'{0}'
+            else:
+                continue
+
+            if not banner:
+                yield _table_banner(table, family)
+                banner = True
+            yield u''.join((
+                u"\033[0m",
+                col256(u" Chain ", bg=255, fg=232), u' ',
+                header.format(_colorize_chain_name((new or old).name)[1]),
+                u'\n'))
+            for line in iter_table_lines([table_header] + rows):
+                yield line
+            yield u'\n'
+
+
+def diff_snapshots(old_path, new_path=None, families=(4,), counters=True):
+    """Compare a snapshot with another one, or with the live ruleset"""
+    _, old_dumps = load_snapshot(old_path)
+    if new_path is not None:
+        _, new_dumps = load_snapshot(new_path)
+    else:
+        new_dumps = dict(
+            (family, subprocess.check_output(COMMANDS[family][1] + ['-c']))
+            for family in families)
+
+    for family in sorted(set(old_dumps) & set(new_dumps)):
+        lines = iter_diff_lines(parse_iptables_save(old_dumps[family], family),
+                                parse_iptables_save(new_dumps[family], family),
+                                family, counters)
+        for line in lines:
+            sys.stdout.write(line.encode('utf-8'))
+
+
+def _synthetic_ruleset(count, user_chains=50):
+    """Generate an ``iptables-save -c`` dump with ``count`` rules"""
+    rnd = random.Random(count)
+    chains = ['INPUT', 'FORWARD', 'OUTPUT']
+    chains += ['chain-{0}'.format(i) for i in range(user_chains)]
+    targets = ['ACCEPT', 'DROP', 'REJECT', 'RETURN', 'LOG'] + chains[3:]
+    interfaces = ['*', 'lo', 'green0', 'red0', 'tun0', 'eth0']
+
+    def _addr():
+        if rnd.random() < 0.5:
+            return '0.0.0.0/0'
+        return '10.{0}.{1}.{2}/{3}'.format(
+            rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255),
+            rnd.choice((8, 16, 24, 32)))
+
+    lines = ['*filter']
+    rules = OrderedDict()
+    for chain in chains:
+        policy = '-' if chain.startswith('chain-') else 'ACCEPT'
+        lines.append(':{0} {1} [0:0]'.format(chain, policy))
+        rules[chain] = []
+    for i in range(count):
+        chain = rnd.choice(chains)
+        parts = ['[{0}:{1}]'.format(rnd.randint(0, 10 ** 6),
+                                   rnd.randint(0, 10 ** 9)),
+                 '-A', chain]
+        iface = rnd.choice(interfaces)
+        if iface != '*':
+            parts += ['-i', iface]
+        parts += ['-s', _addr(), '-d', _addr()]
+        proto = rnd.choice(('all', 'tcp', 'udp'))
+        if proto != 'all':
+            parts += ['-p', proto, '-m', proto,
+                      '--dport', str(rnd.randint(1, 65535))]
+        if rnd.random() < 0.2:
+            parts += ['-m', 'comment', '--comment', '"rule {0}"'.format(i)]
+        parts += ['-j', rnd.choice(targets)]
+        rules[chain].append(' '.join(parts))
+    for chain_rules in rules.values():
+        lines.extend(chain_rules)
+    lines.append('COMMIT')
+    return '\n'.join(lines) + '\n'
+
+
+def run_benchmark(count):
+    """Print parse / render throughput on a synthetic ruleset"""
+    text = _synthetic_ruleset(count)
+
+    start = time.time()
+    tables = parse_iptables_save(text)
+    parsed = time.time()
+    for chains in tables.values():
+        for line in iter_colorized_chains(chains.values()):
+            pass
+    rendered = time.time()
+
+    print('{0} rules: parse {1:.2f}s ({2:.0f} rows/s), '
+          'render {3:.2f}s ({4:.0f} rows/s)'.format(
+              count, parsed - start, count / (parsed - start),
+              rendered - parsed, count / (rendered - parsed)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Dump iptables configuration, in a readable format')
+    parser.add_argument(
+        '--backend', choices=('save', 'list'), default='save',
+        help='Read rules from a single "iptables-save -c" snapshot (default) '
+        'or by running "iptables --list" once per table')
+    parser.add_argument(
+        '-f', '--family', choices=('4', '6', 'both'), default='4',
+        help='Dump IPv4 rules (default), IPv6 rules, or both. The IPv6 '
+        'commands can be overridden via $IP6TABLES / $IP6TABLES_SAVE')
+    parser.add_argument(
+        '-j', '--jobs', type=int, metavar='N',
+        help='Run commands and render tables on a pool of N processes')
+    parser.add_argument(
+        '--stream', action='store_true', default=False,
+        help='Print each chain as soon as it has been read and laid out, '
+        'instead of reading everything first')
+    parser.add_argument(
+        '--fixed-width', action='store_true', default=False,
+        help='Use fixed column widths, so that (with --stream) output can '
+        'start from the first rule')
+    parser.add_argument(
+        '--format', choices=('text', 'jsonl', 'csv'), default='text',
+        help='Output format: colored tables (default), or one JSON / CSV '
+        'record per rule')
+    parser.add_argument(
+        '--save-snapshot', metavar='FILE',
+        help='Save the current ruleset (with counters) to FILE')
+    parser.add_argument(
+        '--diff', nargs='+', metavar='SNAPSHOT',
+        help='Show rules added, removed and moved (and counter changes) '
+        'between two snapshot files, or between one and the live ruleset')
+    parser.add_argument(
+        '--no-counters', action='store_false', dest='counters', default=True,
+        help='With --diff, ignore rules that only had their counters change')
+    parser.add_argument(
+        '--rate', type=float, metavar='INTERVAL',
+        help='Sample counters twice, INTERVAL seconds apart, and show '
+        'packets/s and bytes/s for each rule (always uses iptables-save)')
+    parser.add_argument(
+        '--watch', action='store_true', default=False,
+        help='With --rate, keep sampling and refreshing the screen')
+    parser.add_argument(
+        '--profile', action='store_true', default=False,
+        help='Rank rules by how many rule evaluations their packets paid '
+        'to reach them, and suggest safe reorderings')
+    parser.add_argument(
+        '--top', type=int, default=20, metavar='N',
+        help='Number of entries in --profile reports (default: 20)')
+    parser.add_argument(
+        '--benchmark', type=int, metavar='RULES',
+        help='Measure parsing and rendering speed on a synthetic ruleset '
+        'with this many rules, instead of dumping the real one')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.benchmark:
+        run_benchmark(args.benchmark)
+        return
+
+    families = (4, 6) if args.family == 'both' else (int(args.family),)
+    if 6 in families and None in COMMANDS[6]:
+        sys.exit('Cannot tell the IPv6 commands from {0!r}: set $IP6TABLES '
+                 '(and $IP6TABLES_SAVE)'.format(' '.join(IPTABLES)))
+    col_widths = FIXED_COLUMN_WIDTHS if args.fixed_width else None
+    if args.save_snapshot:
+        save_snapshot(args.save_snapshot, families)
+        return
+
+    if args.diff:
+        if len(args.diff) > 2:
+            sys.exit('--diff takes one or two snapshot files')
+        diff_snapshots(args.diff[0], (args.diff[1:] or [None])[0], families,
+                       counters=args.counters)
+        return
+
+    if args.format != 'text':
+        export_rules(families, backend=args.backend, fmt=args.format)
+        return
+
+    if args.profile:
+        profile_rules(families, top=args.top)
+        return
+
+    if args.rate or args.watch:
+        try:
+            watch_rates(args.rate or 1, families, watch=args.watch,
+                        col_widths=col_widths)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    dump(families, backend=args.backend, stream=args.stream,
+         col_widths=col_widths, jobs=args.jobs)
+
+
+if __name__ == '__main__':
+    main()
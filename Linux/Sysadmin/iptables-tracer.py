@@ -5,68 +5,1004 @@ Script to parse TRACE iptables messages from syslog and display output
 in a more readable fashion.
 """
 
+from __future__ import print_function
+
+import Queue
+import argparse
+import array
+import collections
+import errno
+import gzip
+import io
+import multiprocessing
 import os
+import random
+import re
+import select
 import shlex
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+try:
+    import inotify.adapters
+except ImportError:  # Fall back to polling the followed file
+    inotify = None
 
 
 IPTABLES = ['iptables']
 if 'IPTABLES' in os.environ:
     IPTABLES = shlex.split(os.environ['IPTABLES'])
 
+# iptables-save lives next to iptables; can be overridden too.
+IPTABLES_SAVE = IPTABLES[:-1] + [IPTABLES[-1] + '-save']
+if 'IPTABLES_SAVE' in os.environ:
+    IPTABLES_SAVE = shlex.split(os.environ['IPTABLES_SAVE'])
+
+
+def _ip6_command(command):
+    """The IPv6 twin of an IPv4 ``command`` (ip6tables-legacy-save for
+    iptables-legacy-save...), or None when its name doesn't say"""
+    head, name = os.path.split(command[-1])
+    if 'iptables' not in name:
+        return None
+    return command[:-1] + [
+        os.path.join(head, name.replace('iptables', 'ip6tables', 1))]
+
+
+# Same for IPv6, derived from the IPv4 commands unless overridden
+IP6TABLES_SAVE = _ip6_command(IPTABLES_SAVE)
+if 'IP6TABLES_SAVE' in os.environ:
+    IP6TABLES_SAVE = shlex.split(os.environ['IP6TABLES_SAVE'])
+
 
 # Aug 27 15:44:28 infrastructure kernel: TRACE: mangle:PREROUTING:rule:1 IN=red0 OUT= MAC=00:15:5d:24:58:05:00:1b:17:00:01:31:08:00 SRC=77.72.198.97 DST=193.205.196.227 LEN=52 TOS=0x00 PREC=0x00 TTL=58 ID=55053 DF PROTO=TCP SPT=35519 DPT=443 SEQ=2503161252 ACK=2924600051 WINDOW=8180 RES=0x00 ACK URGP=0 OPT (0101080A299AA81307BD9110)   # noqa
 
+# Size of the chunks read from the input at once
+READ_SIZE = 1 << 20
+
+# Size of the pieces plain log files are split into for the worker pool
+FILE_CHUNK_SIZE = 16 << 20
+
+# Kernel log device read by --follow
+KMSG = '/dev/kmsg'
+
+# Attributes identifying a single packet across its TRACE lines
+FLOW_KEY = ('SRC', 'DST', 'PROTO', 'SPT', 'DPT', 'ID', 'SEQ')
+
+# Chains a packet starts its traversal at (where TRACE is set)
+FLOW_START = frozenset([('raw', 'PREROUTING'), ('raw', 'OUTPUT')])
+
 
 class RecordInfo(object):
-    def __init__(self):
-        self.table = None
-        self.chain = None
-        self.action = None
-        self.lineno = None
-        self.attrs = {}
-        self.flags = []
+    __slots__ = ('table', 'chain', 'action', 'lineno', 'attrs', 'flags',
+                 'rule')
+
+    def __init__(self, table=None, chain=None, action=None, lineno=None,
+                 attrs=None, flags=None, rule=None):
+        self.table = table
+        self.chain = chain
+        self.action = action
+        self.lineno = lineno
+        self.attrs = {} if attrs is None else attrs
+        self.flags = [] if flags is None else flags
+        self.rule = rule
+
+    def __repr__(self):
+        info = ['table={0} chain={1} action={2} lineno={3}'.format(
+            self.table, self.chain, self.action, self.lineno)]
+        info.extend(map('='.join, sorted(self.attrs.iteritems())))
+        info.extend(self.flags)
+        if self.rule is not None:
+            info.append('rule="{0}"'.format(self.rule))
+        return '<{0}({1})>'.format(self.__class__.__name__, ' '.join(info))
+
+
+class Flow(object):
+    """The path of one packet through the tables, in traversal order"""
+    __slots__ = ('key', 'hops', 'last_seen', 'location')
+
+    def __init__(self, key, last_seen):
+        self.key = key
+        self.hops = []
+        self.last_seen = last_seen
+        self.location = None  # (table, chain) of the last hop
 
     def __repr__(self):
-        info = [
-            'table={0}'.format(self.table),
-            'chain={0}'.format(self.chain),
-            'action={0}'.format(self.action),
-            'lineno={0}'.format(self.lineno),
-        ]
-        for k, v in sorted(self.attrs.iteritems()):
-            info.append('{0}={1}'.format(k, v))
-        for f in self.flags:
-            info.append(f)
+        info = ['{0}={1}'.format(name, value)
+                for name, value in zip(FLOW_KEY, self.key) if value]
+        info.append('path=' + ' -> '.join(self.hops))
         return '<{0}({1})>'.format(self.__class__.__name__, ' '.join(info))
 
 
-for line in sys.stdin:
-    startpos = line.find('TRACE:')
-    if startpos < 0:
-        continue
-    tokens = iter(line[startpos:].split())
-    assert next(tokens) == 'TRACE:'
+class FlowTable(object):
+    """Group records by packet, emitting each path once it is complete.
+
+    A flow is complete when no record for it arrived in ``timeout``
+    seconds, or when the same packet starts a new traversal (shows up in
+    a start chain again after having left it). Flows are
+    kept oldest first and the oldest ones are emitted early once there
+    are more than ``max_flows``, so memory stays flat on long traces.
+    """
+
+    def __init__(self, timeout=1.0, max_flows=65536):
+        self.timeout = timeout
+        self.max_flows = max_flows
+        self.flows = collections.OrderedDict()
+
+    def add(self, record, now):
+        """Add a record, returning the flows completed by it"""
+        attrs = record.attrs
+        key = tuple(attrs.get(name) for name in FLOW_KEY)
+        done = []
+
+        location = (record.table, record.chain)
+        flow = self.flows.pop(key, None)
+        if (flow is not None and location in FLOW_START and
+                flow.location not in FLOW_START):
+            done.append(flow)
+            flow = None
+        if flow is None:
+            flow = Flow(key, now)
+            if len(self.flows) >= self.max_flows:
+                done.append(self.flows.popitem(last=False)[1])
+        flow.hops.append('{0}:{1}:{2}:{3}'.format(
+            record.table, record.chain, record.action, record.lineno))
+        flow.last_seen = now
+        flow.location = location
+        self.flows[key] = flow
+        return done
+
+    def expire(self, now):
+        """Remove and return the flows idle for longer than the timeout"""
+        done = []
+        deadline = now - self.timeout
+        flows = self.flows
+        while flows:
+            key = next(iter(flows))
+            if flows[key].last_seen > deadline:
+                break
+            done.append(flows.pop(key))
+        return done
+
+    def flush(self):
+        """Remove and return all the pending flows"""
+        done = list(self.flows.values())
+        self.flows.clear()
+        return done
+
+
+# TRACE: <table>:<chain>:<action>:<lineno> <attributes...>
+_TRACE_RE = re.compile(
+    r'TRACE: ([^:\s]+):([^:\s]+):([^:\s]+):([^:\s]+)(.*)$')
+
+
+def parse_record(line):
+    """Parse a single log line, returning None if it is not a TRACE"""
+    m = _TRACE_RE.search(line)
+    if m is None:
+        return None
+    table, chain, action, lineno, rest = m.groups()
+
+    attrs = {}
+    flags = []
+    for tok in rest.split():
+        key, sep, value = tok.partition('=')
+        if sep:
+            attrs[key] = value
+        else:
+            flags.append(tok)
+    if 'OPT' in flags:  # "OPT (<hex>)"
+        i = flags.index('OPT')
+        attrs['OPT'] = flags[i + 1] if i + 1 < len(flags) else ''
+        del flags[i:i + 2]
+
+    return RecordInfo(table, chain, action, lineno, attrs, flags)
+
+
+# --filter 'SRC=10.0.0.5 and (DPT=443 or DPT=80) and not chain=OUTPUT'
+_FILTER_TOKEN_RE = re.compile(r'\s*(\(|\)|[^\s()]+)')
+_FILTER_TERM_RE = re.compile(r'^([A-Za-z0-9_]+)(!?=)(.*)$')
+_HEADER_FIELDS = {
+    'table': ('TRACE: {0}:', lambda record: record.table),
+    'chain': (':{0}:', lambda record: record.chain),
+    'action': (':{0}:', lambda record: record.action),
+    'lineno': (':{0} ', lambda record: record.lineno),
+}
+
+
+def _filter_term(token):
+    """Compile ``NAME=VALUE``, ``NAME!=VALUE`` or a bare ``FLAG``.
+
+    Returns ``(predicate, clauses)``, see ``_compile_filter_expr()``.
+    """
+    m = _FILTER_TERM_RE.match(token)
+    if m is None:
+        if not token.replace('_', '').isalnum():
+            raise ValueError('Invalid filter term: {0!r}'.format(token))
+        return (lambda record: token in record.flags), [[token]]
+
+    name, op, value = m.groups()
+    if name in _HEADER_FIELDS:
+        pattern, getter = _HEADER_FIELDS[name]
+        needle = pattern.format(value)
+    else:
+        needle = '{0}={1}'.format(name, value)
+        getter = lambda record: record.attrs.get(name)  # noqa
+    if op == '!=':
+        return (lambda record: getter(record) != value), []
+    return (lambda record: getter(record) == value), [[needle]]
+
+
+def _compile_filter_expr(tokens):
+    """Recursive descent parser for ``or``, ``and``, ``not`` and ``()``.
+
+    Each sub-expression compiles to a predicate on records and to the
+    substrings a line must contain to possibly match, as a list of
+    clauses of which every one needs at least one of its substrings.
+    """
+    def parse_or():
+        pred, clauses = parse_and()
+        while tokens and tokens[0] == 'or':
+            tokens.pop(0)
+            rhs, rhs_clauses = parse_and()
+            pred = (lambda a, b: lambda r: a(r) or b(r))(pred, rhs)
+            if clauses and rhs_clauses:
+                clauses = [sorted(set(clauses[0]) | set(rhs_clauses[0]))]
+            else:
+                clauses = []
+        return pred, clauses
+
+    def parse_and():
+        pred, clauses = parse_not()
+        while tokens and tokens[0] == 'and':
+            tokens.pop(0)
+            rhs, rhs_clauses = parse_not()
+            pred = (lambda a, b: lambda r: a(r) and b(r))(pred, rhs)
+            clauses = clauses + rhs_clauses
+        return pred, clauses
+
+    def parse_not():
+        if not tokens:
+            raise ValueError('Unexpected end of filter')
+        token = tokens.pop(0)
+        if token == 'not':
+            pred, _ = parse_not()
+            return (lambda r: not pred(r)), []
+        if token == '(':
+            result = parse_or()
+            if not tokens or tokens.pop(0) != ')':
+                raise ValueError('Missing ) in filter')
+            return result
+        if token in ('and', 'or', ')'):
+            raise ValueError('Unexpected {0!r} in filter'.format(token))
+        return _filter_term(token)
+
+    result = parse_or()
+    if tokens:
+        raise ValueError('Unexpected {0!r} in filter'.format(tokens[0]))
+    return result
+
+
+def compile_filter(text):
+    """Compile a filter expression into ``(prescan, predicate)``.
+
+    ``prescan(line)`` only does substring checks and rejects most lines
+    that can't match; ``predicate(record)`` takes the final decision on
+    the parsed records of the lines that passed.
+    """
+    tokens = _FILTER_TOKEN_RE.findall(text)
+    if not tokens:
+        raise ValueError('Empty filter')
+    predicate, clauses = _compile_filter_expr(tokens)
+
+    required = tuple(clause[0] for clause in clauses if len(clause) == 1)
+    alternatives = tuple(tuple(clause) for clause in clauses
+                         if len(clause) > 1)
+
+    def prescan(line):
+        for needle in required:
+            if needle not in line:
+                return False
+        for clause in alternatives:
+            if not any(needle in line for needle in clause):
+                return False
+        return True
+
+    return prescan, predicate
+
+
+_SAVE_LINE_RE = re.compile(
+    r'^(?:\[\d+:\d+\] )?(?:\*(\S+)|:(\S+) (\S+)|-A (\S+) )', re.M)
+
+
+class RuleIndex(object):
+    """Map the positions in TRACE lines back to the rules they refer to.
+
+    The ruleset is loaded with a single ``iptables-save`` call. It is
+    reloaded when a record refers to a rule or chain past what is known
+    (the ruleset changed), but at most once every ``min_refresh``
+    seconds, so this never shells out for each record.
+    """
+
+    def __init__(self, command, min_refresh=5.0, clock=time.time):
+        self.command = command
+        self.min_refresh = min_refresh
+        self.clock = clock
+        self.loaded = None
+        self.rules = {}     # {(table, chain): [rule, ...]}
+        self.policies = {}  # {(table, chain): policy}
+
+    def load(self):
+        self.loaded = self.clock()
+        try:
+            output = subprocess.check_output(self.command)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Cannot load the ruleset with {0}: {1}'.format(
+                ' '.join(self.command), e), file=sys.stderr)
+            return
+        self.rules, self.policies = self.parse(output)
+
+    @staticmethod
+    def parse(text):
+        rules, policies = {}, {}
+        table = None
+        for m in _SAVE_LINE_RE.finditer(text):
+            new_table, chain, policy, rule_chain = m.groups()
+            if new_table is not None:
+                table = new_table
+            elif chain is not None:
+                if policy != '-':
+                    policies[table, chain] = '-P {0} {1}'.format(
+                        chain, policy)
+            else:
+                end = text.find('\n', m.end())
+                rules.setdefault((table, rule_chain), []).append(
+                    text[m.start(4) - 3:None if end < 0 else end])  # -A...
+        return rules, policies
+
+    def lookup(self, table, chain, action, lineno):
+        """The rule (or policy) text for a TRACE position, or None"""
+        if action == 'return':
+            return None
+        if action == 'policy':
+            key = (table, chain)
+            if key not in self.policies and self._refresh():
+                return self.lookup(table, chain, action, lineno)
+            return self.policies.get(key)
+
+        index = int(lineno) - 1
+        rules = self.rules.get((table, chain), ())
+        if index >= len(rules) and self._refresh():
+            rules = self.rules.get((table, chain), ())
+        return rules[index] if 0 <= index < len(rules) else None
+
+    def _refresh(self):
+        if (self.loaded is not None and
+                self.clock() - self.loaded < self.min_refresh):
+            return False
+        self.load()
+        return True
+
+
+def iter_annotated(batches, indexes):
+    """Set ``rule`` on records, with ``{family: RuleIndex}`` indexes"""
+    for records in batches:
+        for record in records:
+            family = 6 if ':' in record.attrs.get('SRC', '') else 4
+            record.rule = indexes[family].lookup(
+                record.table, record.chain, record.action, record.lineno)
+        yield records
+
+
+def iter_line_batches(fp, size=READ_SIZE):
+    """Read ``fp`` in big chunks, yielding lists of complete lines.
+
+    ``os.read()`` returns whatever is available, so this doesn't wait
+    for a full chunk when following a live log through a pipe.
+    """
+    fd = fp.fileno()
+    return _iter_split(iter(lambda: os.read(fd, size), b''))
+
 
-    location = next(tokens).split(':')
-    assert len(location) == 4
+def _iter_split(chunks):
+    """Turn an iterable of data chunks into lists of complete lines"""
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        if lines:
+            yield lines
+    if pending:
+        yield [pending]
 
-    record = RecordInfo()
-    record.table = location[0]
-    record.chain = location[1]
-    record.action = location[2]
-    record.lineno = location[3]
 
-    for tok in tokens:
-        if '=' in tok:
-            key, val = tok.split('=', 1)
-            record.attrs[key] = val
+def iter_records(batches, filter=None):
+    """Parse batches of lines, yielding lists of ``RecordInfo``
 
-        elif tok == 'OPT':
-            record.attrs['OPT'] = next(tokens)
+    ``filter`` is a ``(prescan, predicate)`` pair from ``compile_filter()``.
+    """
+    if filter is None:
+        for lines in batches:
+            records = [parse_record(line) for line in lines
+                       if b'TRACE:' in line]
+            yield [r for r in records if r is not None]
+        return
 
+    prescan, predicate = filter
+    for lines in batches:
+        records = [parse_record(line) for line in lines
+                   if b'TRACE:' in line and prescan(line)]
+        yield [r for r in records if r is not None and predicate(r)]
+
+
+def iter_flows(batches, table, clock=time.time):
+    """Turn batches of records into batches of completed ``Flow``"""
+    for records in batches:
+        now = clock()
+        flows = table.expire(now)
+        for record in records:
+            flows.extend(table.add(record, now))
+        if flows:
+            yield flows
+    flows = table.flush()
+    if flows:
+        yield flows
+
+
+class LogFollower(object):
+    """Follow a log file or the kernel log device, yielding line batches.
+
+    Reading happens in a background thread feeding a queue of at most
+    ``backlog`` batches, so a slow consumer doesn't stall the reader.
+    When the queue is full, regular files simply wait (they keep the
+    data), while the kernel log, which gets overwritten, drops the batch
+    and counts its lines in ``dropped``. Messages the kernel overwrote
+    before we could read them are counted from the sequence numbers.
+
+    An empty batch is yielded every ``idle`` seconds without input, so
+    consumers get a chance to expire their state.
+    """
+
+    def __init__(self, path=KMSG, kmsg=None, from_start=False,
+                 backlog=64, idle=1.0):
+        self.path = path
+        self.from_start = from_start
+        self.idle = idle
+        self.dropped = 0
+        self.is_device = stat.S_ISCHR(os.stat(path).st_mode)
+        self.kmsg = self.is_device if kmsg is None else kmsg
+        self._queue = Queue.Queue(backlog)
+        self._last_seq = None
+        self._notifier = None
+
+    def __iter__(self):
+        reader = threading.Thread(target=self._read_loop)
+        reader.daemon = True
+        reader.start()
+        while True:
+            try:
+                yield self._queue.get(timeout=self.idle)
+            except Queue.Empty:
+                if not reader.is_alive():
+                    return
+                yield []
+
+    def _open(self, at_end):
+        fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        if at_end:
+            os.lseek(fd, 0, os.SEEK_END)
+        return fd
+
+    def _publish(self, lines):
+        if self.kmsg:
+            self._count_lost(lines)
+        if not self.is_device:
+            self._queue.put(lines)
+            return
+        try:
+            self._queue.put_nowait(lines)
+        except Queue.Full:
+            self.dropped += len(lines)
+
+    def _count_lost(self, lines):
+        """Count the gaps in the "<prio>,<seq>,<usec>,<flags>;" prefixes"""
+        last = self._last_seq
+        for line in lines:
+            fields = line.split(b',', 2)
+            if len(fields) < 3 or not fields[1].isdigit():
+                continue  # Continuation line
+            seq = int(fields[1])
+            if last is not None and seq > last + 1:
+                self.dropped += seq - last - 1
+            last = seq
+        self._last_seq = last
+
+    def _read_loop(self):
+        if self.is_device:
+            self._read_device()
         else:
-            record.flags.append(tok)
+            self._read_file()
+
+    def _read_device(self):
+        # Every read() returns a single message
+        fd = self._open(not self.from_start)
+        while True:
+            select.select([fd], [], [], self.idle)
+            lines = []
+            while len(lines) < 4096:
+                try:
+                    chunk = os.read(fd, 8192)
+                except OSError as e:
+                    if e.errno == errno.EPIPE:  # Overwritten, see seq
+                        continue
+                    if e.errno == errno.EAGAIN:
+                        break
+                    raise
+                if not chunk:
+                    break
+                lines.extend(chunk.rstrip(b'\n').split(b'\n'))
+            if lines:
+                self._publish(lines)
+
+    def _read_file(self):
+        fd = self._open(not self.from_start)
+        ino = os.fstat(fd).st_ino
+        pending = b''
+        while True:
+            chunk = os.read(fd, READ_SIZE)
+            if chunk:
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                if lines:
+                    self._publish(lines)
+                continue
+
+            # Caught up: reopen if the file got rotated or truncated
+            if self._rotated(fd, ino):
+                lines = (pending + self._read_rest(fd)).split(b'\n')
+                pending = b''
+                os.close(fd)
+                fd = self._open(False)
+                ino = os.fstat(fd).st_ino
+                lines = [line for line in lines if line]
+                if lines:
+                    self._publish(lines)
+                continue
+            self._wait()
+
+    def _rotated(self, fd, ino):
+        try:
+            st = os.stat(self.path)
+        except OSError:  # Moved away, the new one isn't there yet
+            return False
+        return (st.st_ino != ino or
+                st.st_size < os.lseek(fd, 0, os.SEEK_CUR))
+
+    @staticmethod
+    def _read_rest(fd):
+        """What was written to a rotated file before we noticed"""
+        data = []
+        chunk = os.read(fd, READ_SIZE)
+        while chunk:
+            data.append(chunk)
+            chunk = os.read(fd, READ_SIZE)
+        return b''.join(data)
+
+    def _wait(self):
+        """Sleep until the followed file (or its directory) changes"""
+        if inotify is None:
+            time.sleep(min(self.idle, 0.2))
+            return
+        if self._notifier is None:
+            self._notifier = inotify.adapters.Inotify()
+            self._notifier.add_watch(os.path.dirname(
+                os.path.abspath(self.path)).encode('utf-8'))
+        for _ in self._notifier.event_gen():
+            return  # An event, or None after a quiet second
+
+
+class TopCounter(object):
+    """Approximate counts of the most frequent keys in fixed memory.
+
+    Counts go to a count-min sketch of ``depth`` rows of ``2**bits``
+    counters, indexed by multiply-shift hashes; only the ``size`` keys
+    with the highest estimates are remembered. ``floor`` is a lower
+    bound of the smallest remembered estimate, so most keys are rejected
+    without scanning the candidates.
+    """
+
+    _MULTIPLIERS = (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f,
+                    0x165667b19e3779f9, 0xd6e8feb86659fd93)
+
+    def __init__(self, size, bits=12, depth=4):
+        self.size = size
+        self.shift = 64 - bits
+        self.rows = [(array.array('L', [0]) * (1 << bits), multiplier)
+                     for multiplier in self._MULTIPLIERS[:depth]]
+        self.top = {}
+        self.floor = 0
+
+    def add(self, key):
+        estimate = None
+        h, shift = hash(key), self.shift
+        for row, multiplier in self.rows:
+            i = ((h * multiplier) & 0xffffffffffffffff) >> shift
+            row[i] += 1
+            if estimate is None or row[i] < estimate:
+                estimate = row[i]
+
+        top = self.top
+        if key in top or len(top) < self.size:
+            top[key] = estimate
+        elif estimate > self.floor:
+            lowest = min(top, key=top.get)
+            if estimate > top[lowest]:
+                del top[lowest]
+                top[key] = estimate
+            self.floor = min(top.itervalues())
+
+    def estimate(self, key):
+        h, shift = hash(key), self.shift
+        return min(row[((h * multiplier) & 0xffffffffffffffff) >> shift]
+                   for row, multiplier in self.rows)
+
+    def merge(self, other):
+        """Add the counts of ``other``, which must have the same shape"""
+        for (row, _), (other_row, _) in zip(self.rows, other.rows):
+            for i, count in enumerate(other_row):
+                if count:
+                    row[i] += count
+        candidates = set(self.top) | set(other.top)
+        self.top = dict(sorted(
+            ((key, self.estimate(key)) for key in candidates),
+            key=lambda kv: -kv[1])[:self.size])
+        self.floor = min(self.top.itervalues()) if self.top else 0
+
+    def most_common(self, n):
+        return sorted(self.top.iteritems(), key=lambda kv: -kv[1])[:n]
+
+
+class TraceStats(object):
+    """Counters over a stream of records, in bounded memory.
+
+    Hits are counted per rule (table, chain, action, lineno), the other
+    breakdowns per packet, on the first record of each traversal of its
+    start chain. To tell those apart, whether each packet (``FLOW_KEY``)
+    was last seen in a start chain is kept in two generations of at most
+    ``max_packets`` entries, the older one dropped when the newer fills.
+    """
+
+    TOP_FIELDS = (('SRC', 'sources'), ('DST', 'destinations'),
+                  ('SPT', 'source ports'), ('DPT', 'destination ports'))
+
+    def __init__(self, top=10, max_packets=65536):
+        self.top = top
+        self.max_packets = max_packets
+        self.records = 0
+        self.packets = 0
+        self.in_start = {}
+        self.old_in_start = {}
+        self.hits = collections.Counter()
+        self.protocols = collections.Counter()
+        self.tops = dict((name, TopCounter(top * 2))
+                         for name, _ in self.TOP_FIELDS)
+
+    def add(self, records):
+        hits = self.hits
+        self.records += len(records)
+        for record in records:
+            hits[record.table, record.chain, record.action,
+                 record.lineno] += 1
+            attrs = record.attrs
+            key = tuple(attrs.get(name) for name in FLOW_KEY)
+            was_in_start = self.in_start.get(key)
+            if was_in_start is None:
+                was_in_start = self.old_in_start.get(key, False)
+            in_start = (record.table, record.chain) in FLOW_START
+            if len(self.in_start) >= self.max_packets:
+                self.old_in_start, self.in_start = self.in_start, {}
+            self.in_start[key] = in_start
+            if not in_start or was_in_start:
+                continue
+
+            self.packets += 1
+            self.protocols[attrs.get('PROTO', '?')] += 1
+            for name, counter in self.tops.iteritems():
+                value = attrs.get(name)
+                if value is not None:
+                    counter.add(value)
+
+    def merge(self, other):
+        self.records += other.records
+        self.packets += other.packets
+        self.hits.update(other.hits)
+        self.protocols.update(other.protocols)
+        for name, counter in self.tops.iteritems():
+            counter.merge(other.tops[name])
+
+    def iter_report_lines(self, elapsed):
+        yield '--- {0} {1:.1f}s: {2} records, {3} packets'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), elapsed, self.records,
+            self.packets)
+        yield 'rule hits:'
+        for key, count in self.hits.most_common(self.top):
+            yield '  {0:>10}  {1}'.format(count, ':'.join(key))
+        yield 'protocols:'
+        for proto, count in self.protocols.most_common():
+            yield '  {0:>10}  {1}'.format(count, proto)
+        for name, title in self.TOP_FIELDS:
+            yield 'top {0}:'.format(title)
+            for value, count in self.tops[name].most_common(self.top):
+                yield '  {0:>10}  {1}'.format(count, value)
+
+
+def write_stats(batches, out, interval, top=10, clock=time.time):
+    """Print a ``TraceStats`` report every ``interval`` seconds"""
+    def report():
+        out.write(''.join(line + '\n' for line in
+                          stats.iter_report_lines(clock() - started)))
+        out.flush()
+
+    stats, started = TraceStats(top), clock()
+    try:
+        for records in batches:
+            stats.add(records)
+            if clock() - started >= interval:
+                report()
+                stats, started = TraceStats(top), clock()
+    finally:
+        if stats.records:
+            report()
+
+
+def write_records(batches, out):
+    for records in batches:
+        out.write(''.join(repr(r) + '\n' for r in records))
+        out.flush()
+
+
+def _file_chunks(path, size=FILE_CHUNK_SIZE):
+    """Split a log file into ``(path, start, end)`` byte ranges.
+
+    Compressed files can't be read from the middle, so each is a single
+    range (``end`` None means up to the end of the file).
+    """
+    if path.endswith('.gz'):
+        return [(path, 0, None)]
+    total = os.path.getsize(path)
+    starts = range(0, total, size) or [0]
+    return [(path, start, start + size if start + size < total else None)
+            for start in starts]
+
+
+def _read_chunk(path, start, end):
+    """The lines beginning in ``[start, end)`` of a log file"""
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as fp:
+            for lines in _iter_split(iter(lambda: fp.read(READ_SIZE), b'')):
+                yield lines
+        return
+
+    with open(path, 'rb') as fp:
+        if start:
+            fp.seek(start - 1)
+            fp.readline()  # Belongs to the previous chunk
+        if end is None:
+            data = fp.read()
+        else:
+            data = fp.read(max(end - fp.tell(), 0))
+            if data and not data.endswith(b'\n'):
+                data += fp.readline()  # Started before end
+    lines = data.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    yield lines
+
+
+def _process_chunk(job):
+    """Pool worker: parse a chunk, returning what ``mode`` asks for"""
+    path, start, end, mode, filter_expr, top = job
+    match = compile_filter(filter_expr) if filter_expr else None
+    batches = iter_records(_read_chunk(path, start, end), match)
+    if mode == 'stats':
+        stats = TraceStats(top)
+        for records in batches:
+            stats.add(records)
+        return stats
+    if mode == 'text':
+        return ''.join(repr(r) + '\n' for records in batches
+                       for r in records)
+    return [r for records in batches for r in records]
+
+
+def process_files(paths, mode, filter_expr=None, top=10, jobs=None):
+    """Parse log files on a pool of ``jobs`` processes.
+
+    Files are split into chunks, parsed in parallel and the results are
+    yielded in input order; ``mode`` is "text" (the rendered records),
+    "records" (lists of ``RecordInfo``) or "stats" (a ``TraceStats`` of
+    each chunk, to be merged).
+    """
+    chunk_jobs = [(path, start, end, mode, filter_expr, top)
+                  for name in paths
+                  for path, start, end in _file_chunks(name)]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(_process_chunk, chunk_jobs):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def _synthetic_log(count, trace_ratio=0.9):
+    """Generate ``count`` kernel log lines, most of them TRACE ones"""
+    rnd = random.Random(count)
+    locations = ['raw:PREROUTING:policy:2', 'mangle:PREROUTING:rule:1',
+                 'nat:PREROUTING:policy:1', 'filter:INPUT:rule:{0}',
+                 'filter:INPUT:return:12', 'filter:FORWARD:rule:{0}']
+    lines = []
+    for i in range(count):
+        stamp = 'Aug 27 15:44:{0:02d} infrastructure kernel: '.format(i % 60)
+        if rnd.random() > trace_ratio:
+            lines.append(stamp + 'eth0: link up, 1000Mbps, full-duplex')
+            continue
+        lines.append(stamp + (
+            'TRACE: {loc} IN=red0 OUT= MAC=00:15:5d:24:58:05:00:1b:17:00:01'
+            ':31:08:00 SRC=77.72.{a}.{b} DST=193.205.196.227 LEN=52 '
+            'TOS=0x00 PREC=0x00 TTL=58 ID={id} DF PROTO=TCP SPT={spt} '
+            'DPT=443 SEQ=2503161252 ACK=2924600051 WINDOW=8180 RES=0x00 '
+            'ACK URGP=0 OPT (0101080A299AA81307BD9110)'.format(
+                loc=rnd.choice(locations).format(rnd.randint(1, 40)),
+                a=rnd.randint(0, 255), b=rnd.randint(0, 255),
+                id=rnd.randint(0, 65535), spt=rnd.randint(1024, 65535))))
+    return '\n'.join(lines) + '\n'
+
+
+def run_benchmark(count):
+    """Print parse / output throughput on a generated log"""
+    with tempfile.TemporaryFile() as fp, open(os.devnull, 'wb') as out:
+        fp.write(_synthetic_log(count))
+        fp.seek(0)
+
+        start = time.time()
+        write_records(iter_records(iter_line_batches(fp)), out)
+        elapsed = time.time() - start
+
+    print('{0} lines: {1:.2f}s ({2:.0f} lines/s)'.format(
+        count, elapsed, count / elapsed))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Parse iptables TRACE messages from a log on stdin, '
+        'or from log files')
+    parser.add_argument(
+        'files', nargs='*', metavar='FILE',
+        help='Log files to read (possibly gzipped), in this order, '
+        'on a pool of processes')
+    parser.add_argument(
+        '-j', '--jobs', type=int, metavar='N',
+        help='Size of the pool reading FILEs (default: number of CPUs)')
+    parser.add_argument(
+        '--benchmark', type=int, metavar='LINES',
+        help='Measure parsing speed on a generated log with this many '
+        'lines, instead of reading stdin')
+    parser.add_argument(
+        '--follow', nargs='?', const=KMSG, metavar='PATH',
+        help='Follow the kernel log (default: {0}) or a log file, '
+        'reopening it when rotated, instead of reading stdin'.format(KMSG))
+    parser.add_argument(
+        '--kmsg', action='store_true',
+        help='The followed file has the {0} format (detected for '
+        'character devices)'.format(KMSG))
+    parser.add_argument(
+        '--from-start', action='store_true',
+        help='Also process what was already logged before following')
+    parser.add_argument(
+        '--backlog', type=int, default=64, metavar='BATCHES',
+        help='Batches of lines to buffer when following before dropping '
+        'kernel messages (default: %(default)s)')
+    parser.add_argument(
+        '--filter', metavar='EXPR',
+        help='Only consider the records matching EXPR, made of NAME=VALUE, '
+        'NAME!=VALUE and FLAG terms combined with and, or, not and '
+        'parentheses; NAME is a log attribute (SRC, DPT...) or table, '
+        'chain, action, lineno')
+    parser.add_argument(
+        '--rules', action='store_true',
+        help='Show the rule each record refers to, from iptables-save')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='Print hit counts per rule and the top addresses, ports '
+        'and protocols instead of the records')
+    parser.add_argument(
+        '--interval', type=float, default=10, metavar='SECONDS',
+        help='Print (and reset) the statistics this often '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--top', type=int, default=10, metavar='N',
+        help='Number of entries in each statistics table '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--flows', action='store_true',
+        help='Group the records of each packet, printing its whole path '
+        'through the tables on a single line')
+    parser.add_argument(
+        '--flow-timeout', type=float, default=1.0, metavar='SECONDS',
+        help='Consider a packet path complete after this long without '
+        'new records (default: %(default)s)')
+    parser.add_argument(
+        '--max-flows', type=int, default=65536, metavar='N',
+        help='Maximum number of packet paths kept in memory '
+        '(default: %(default)s)')
+    args = parser.parse_args()
+    if args.rules and IP6TABLES_SAVE is None:
+        parser.error('cannot tell the IPv6 command from {0!r}: set '
+                     '$IP6TABLES_SAVE'.format(' '.join(IPTABLES_SAVE)))
+    args.filter_expr = args.filter
+    if args.filter is not None:
+        try:
+            args.filter = compile_filter(args.filter)
+        except ValueError as e:
+            parser.error(e)
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.benchmark:
+        run_benchmark(args.benchmark)
+        return
+
+    out = io.open(sys.stdout.fileno(), 'wb', buffering=1 << 16,
+                  closefd=False)
+    follower = None
+    if args.files:
+        if args.stats:
+            started, stats = time.time(), TraceStats(args.top)
+            for chunk_stats in process_files(args.files, 'stats',
+                                             args.filter_expr, args.top,
+                                             args.jobs):
+                stats.merge(chunk_stats)
+            out.write(''.join(line + '\n' for line in
+                              stats.iter_report_lines(time.time() - started)))
+            out.flush()
+            return
+        if not (args.rules or args.flows):
+            for text in process_files(args.files, 'text', args.filter_expr,
+                                      jobs=args.jobs):
+                out.write(text)
+            out.flush()
+            return
+        batches = process_files(args.files, 'records', args.filter_expr,
+                                jobs=args.jobs)
+    elif args.follow:
+        follower = LogFollower(args.follow, args.kmsg or None,
+                               args.from_start, args.backlog)
+        batches = iter_records(follower, args.filter)
+    else:
+        batches = iter_records(iter_line_batches(sys.stdin), args.filter)
+    if args.rules:
+        batches = iter_annotated(batches, {4: RuleIndex(IPTABLES_SAVE),
+                                           6: RuleIndex(IP6TABLES_SAVE)})
+    if args.flows and not args.stats:
+        batches = iter_flows(
+            batches, FlowTable(args.flow_timeout, args.max_flows))
+    try:
+        if args.stats:
+            write_stats(batches, out, args.interval, args.top)
+        else:
+            write_records(batches, out)
+    except KeyboardInterrupt:
+        pass
+    if follower is not None and follower.dropped:
+        print('{0} kernel log messages dropped'.format(follower.dropped),
+              file=sys.stderr)
+
 
-    print(record)
+if __name__ == '__main__':
+    main()